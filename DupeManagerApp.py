@@ -3,35 +3,80 @@
 """ DupeManagerApp.py contains an application class designed to provide features around directory and file nodes. """
 
 import os
-import contextlib
+import signal
+import socket
 import time
 
+import checkpoint
+import dupelog
+import external
+import grouping
+import hashdb
+import hashpool
+import matcher
 import nodes
+import removal
+import server
+import shards
+import snapshot
+import stats
 from localutils import *
 
 
 class DupeManagerApp():
     def __init__(self, verbosity=1):
         self.real_orig = None
-        self.rmqueue = []
+        self.extras = []
+        self.rmqueue = removal.RemovalQueue(protected=self.extras)
+        self.rmlog = None
         self.force_removal = False
         self.check_removal = False
-        self.extras = []
         self.exclusions = []
-        self.trash_dirs = ['.Trash', ]
+        # Trash directories: plain, per-user on Linux removable media, and per-volume on macOS
+        self.trash_dirs = ['.Trash', '.Trash-*', '.Trashes', ]
         self.overlaps = []
+        self.excluder = None
+        self.overlapper = None
         self.verbosity = verbosity
         self.num_orig_dupes = 0
         self.size_orig_dupes = 0
         self.num_extras_dupes = 0
         self.size_extras_dupes = 0
+        self.reclaimable = grouping.Reclaimable()
+        # Protected files matched, so several names for one inode only count its bytes once
+        self.matched = grouping.Reclaimable()
+        # Files already reported within a group of copies in a single tree, so no group is reported twice
+        self.grouped = set()
+        self.num_hard_links = 0
+        self.num_dir_dupes = 0
+        self.dir_reclaimable = grouping.Reclaimable()
         self.last_run_start = 0
         self.last_run_end = 0
         self.num_files_to_check = 0
+        self.hashdb = None
+        self.dupelog = None
+        self.snapshot_path = None
+        self.snapshot = None
+        self.max_memory = None
+        self.checkpoint = None
+        self.resume = False
+        self.time_budget = None
+        self.deadline = None
+        self.searched = []
+        self.num_hashes_saved = 0
+        self.num_scripted = 0
+        self.jobs = 1
+        self.rotational_jobs = hashpool.ROTATIONAL_JOBS
+        self.walkers = 1
+        self.hash_algorithm = 'sha256'
+        self.blocksize = None
+        self.pool = None
+        self.stats = stats.RunStats()
 
-    def print(self, s, v=1):
+    def print(self, s, *args, v=1):
+        """Print s if verbosity is at least v, formatted with args only then, so quiet runs never pay to format."""
         if self.verbosity >= v:
-            print(s)
+            print(s.format(*args) if args else s)
 
     def remove_queued(self):
         if len(self.rmqueue) == 0:
@@ -39,11 +84,16 @@ class DupeManagerApp():
         self.print("Removal queue:", v=0)
         for f in self.rmqueue:
             self.print(f, v=0)
+        if self.rmlog is not None:
+            # Removals queued a batch at a time are added to the script already begun.
+            self.num_scripted += self.rmqueue.write_script(self.rmlog, append=self.num_scripted > 0)
+            self.print("Wrote {0} to remove {1} duplicate files; nothing was deleted.", self.rmlog, self.num_scripted, v=0)
+            return
         while True:
             if self.force_removal:
                 break
             try:
-                self.print("{0} duplicate files found.".format(len(self.rmqueue)))
+                self.print("{0} duplicate files found.", len(self.rmqueue))
                 delete_rule = input(
                     "Shall I \n\tA) Remove them all?\n\tB) Ask again for each file?\n\tC) Quit without deleting anything?\n")
                 if delete_rule == "A" or delete_rule == "a":
@@ -67,195 +117,616 @@ class DupeManagerApp():
             else:
                 break
         if self.force_removal:
-            for f in self.rmqueue:
-                with contextlib.suppress(FileNotFoundError):
-                    os.remove(f.full_path)
-                    parent_dir = os.path.abspath(os.path.join(f.full_path, os.pardir))
-                    if os.path.isdir(parent_dir) and len(os.listdir(parent_dir)) < 1 and parent_dir not in self.extras:
-                        self.print("    - removing {0} too".format(parent_dir), v=1)
-                        os.rmdir(parent_dir)
-                        # TODO: If access is denied, hang on and ask to save a remove log or wait for permissions to be granted.
+            self.rmqueue.remove()
         elif self.check_removal:
+            approved = []
             for f in self.rmqueue:
                 r = input("Remove {0}?".format(f.full_path))
                 if r == "Y" or r == "y":
-                    with contextlib.suppress(FileNotFoundError):
-                        os.remove(f.full_path)
-                        parent_dir = os.path.abspath(os.path.join(f.full_path, os.pardir))
-                        if len(os.listdir(parent_dir)) < 1 and parent_dir not in self.extras:
-                            self.print("    - removing {0} too".format(parent_dir), v=1)
-                            os.rmdir(parent_dir)
-                            # TODO: If access is denied, hang on and ask to save a remove log or wait for permissions to be granted.
-
-    def rm(self, f):
-        if f.full_path not in self.rmqueue:
-            self.print("Queuing {0} for removal".format(f.full_path), v=4)
-            if f not in self.rmqueue:
-                self.rmqueue.append(f)
+                    approved.append(f)
+            self.rmqueue.remove(approved)
+        for dir_path in self.rmqueue.removed_dirs:
+            self.print("    - removing {0} too", dir_path, v=1)
+        for path, e in self.rmqueue.errors:
+            # TODO: If access is denied, hang on and ask to save a remove log or wait for permissions to be granted.
+            self.print("    could not remove {0}: {1}", path, e, v=0)
+
+    def rm(self, f, originals=None):
+        if self.rmqueue.add(f, originals):
+            self.print("Queuing {0} for removal", f.full_path, v=4)
 
     def dbconfig(self, dbfile):
-        self.print("DB configuration is not yet implemented.", v=0)
+        """Cache file hashes in the sqlite database at dbfile, so unchanged files are never hashed twice."""
+        self.hashdb = hashdb.HashDB(dbfile)
+        self.print("  caching hashes in {0}", self.hashdb.dbfile, v=2)
+
+    def snapshotconfig(self, snapshot_path):
+        """List directories unchanged since the last run from the snapshot at snapshot_path, rather than walking them."""
+        self.snapshot_path = snapshot_path
+
+    def load_snapshot(self):
+        """Start this run's snapshot, from the one saved last time if its exclusions match ours."""
+        self.snapshot = snapshot.Snapshot(excluding=self.exclusions + self.trash_dirs)
+        if self.snapshot_path is not None:
+            num_dirs = self.snapshot.load(self.snapshot_path)
+            self.print("  loaded {0} directories from snapshot {1}", num_dirs, self.snapshot_path, v=2)
+
+    def save_snapshot(self, trees):
+        if self.snapshot is not None and self.snapshot_path is not None:
+            self.snapshot.prune([t.full_path for t in trees if isinstance(t, nodes.DirNode)])
+            self.snapshot.save(self.snapshot_path)
+            self.print("  {0}, and saved snapshot {1}", self.snapshot, self.snapshot_path, v=2)
+
+    def checkpointconfig(self, checkpoint_dir, every=300, resume=False):
+        """Save this run's hashes, listings and pending removals in checkpoint_dir every so often, and on any stop.
+
+        Unless --db or --snapshot already keep them elsewhere, hashes and listings are kept in checkpoint_dir too,
+        once the run starts. With resume, an unfinished run with the same arguments picks up from there.
+        """
+        self.checkpoint = checkpoint.Checkpoint(checkpoint_dir, every=every)
+        self.resume = resume
+        self.print("  checkpointing to {0} every {1}", self.checkpoint, time_str(self.checkpoint.every), v=2)
+
+    def start_checkpoint(self, run):
+        resumed = self.checkpoint.start(run, resume=self.resume)
+        # Only now that any stale hashes and listings of another run are gone can the checkpoint's own be used.
+        if self.hashdb is None:
+            self.dbconfig(self.checkpoint.hashdb_path)
+        if self.snapshot_path is None:
+            self.snapshotconfig(self.checkpoint.snapshot_path)
+        if resumed:
+            removals = self.checkpoint.load_removals()
+            for node, originals in removals:
+                self.rm(node, originals)
+            self.print("  resuming from {0}, with {1} removals still pending", self.checkpoint, len(removals), v=1)
+        elif self.resume:
+            self.print("  nothing to resume in {0}, starting over", self.checkpoint, v=1)
+
+    def save_checkpoint(self):
+        """Save every hash computed so far, every directory listed so far, and every removal still pending."""
+        self.save_hashes(self.searched, quietly=True)
+        if self.snapshot is not None:
+            # A walk may have stopped partway, so nothing it didn't reach is pruned.
+            self.snapshot.save(self.snapshot_path)
+        self.checkpoint.save_removals(self.rmqueue)
+        self.checkpoint.last_saved = time.time()
+        self.print("  checkpointed {0} queued removals to {1}", len(self.rmqueue), self.checkpoint, v=3)
+
+    def tick(self):
+        """Stop with a TimeoutError once the time budget is spent, and save a checkpoint whenever one is due."""
+        if self.deadline is not None and time.time() > self.deadline:
+            raise TimeoutError("the time budget of {0} is spent".format(time_str(self.time_budget)))
+        if self.checkpoint is not None and self.checkpoint.due():
+            self.save_checkpoint()
+
+    def stop(self, reason):
+        """Save a checkpoint, if any, and leave it resumable, after an interruption or when the time budget runs out."""
+        if self.checkpoint is not None:
+            self.save_checkpoint()
+            self.checkpoint.finish('stopped')
+        self.report_errors()
+        if self.dupelog is not None:
+            self.dupelog.close()
+        self.last_run_end = time.time()
+        self.print("Stopped after {0}{1}; nothing more was removed.", time_str(self.last_run_end - self.last_run_start),
+                   ", as " + str(reason) if isinstance(reason, TimeoutError) else "", v=0)
+        if self.checkpoint is not None:
+            self.print("  Run again with --resume to pick up from {0}.", self.checkpoint, v=0)
+
+    def logconfig(self, log_path):
+        """Stream every group of duplicates found to log_path, as JSON lines, or as CSV if it ends in .csv."""
+        self.dupelog = dupelog.DupeLog(log_path)
+        self.print("  logging duplicates to {0} as {1}", self.dupelog.log_path, self.dupelog.fmt, v=2)
+
+    def log_dupes(self, keep, dupes, links=None):
+        if self.dupelog is not None:
+            self.dupelog.write(keep, dupes, links)
+
+    def report_progress(self, tier, done, total):
+        self.tick()
+        if done == total or done % 1000 == 0:
+            self.print("  {0} hashed {1} of {2} files", tier, done, total, v=3)
+
+    def report_errors(self):
+        if self.pool is not None and len(self.pool.errors) > 0:
+            self.print("{0} files could not be read, and were not compared:", len(self.pool.errors), v=1)
+            for f in self.pool.errors:
+                self.print("  {0}: {1}", f.full_path, f.hash_error, v=1)
+
+    def load_hashes(self, files):
+        if self.hashdb is not None:
+            self.hashdb.prime(files)
+
+    def save_hashes(self, trees, quietly=False):
+        if self.hashdb is not None:
+            for t in trees:
+                self.num_hashes_saved += self.hashdb.save(t)
+            if not quietly:
+                self.print("  saved {0} new hashes to {1}", self.num_hashes_saved, self.hashdb, v=2)
 
     def add_to_extras(self, paths):
         if paths:
             for p in paths:
-                if os.path.exists(p):
-                    self.print("  will check {0}".format(os.path.abspath(p.rstrip(os.sep))), v=2)
+                if os.path.exists(p) and self.real_orig is not None and matcher.path_within(self.real_orig, p):
+                    # Every original would match itself, and be queued for removal along with the real extras.
+                    self.print("  {0} holds the originals in {1}, cannot check it against them.",
+                               os.path.abspath(p.rstrip(os.sep)), self.real_orig, v=0)
+                elif os.path.exists(p):
+                    self.print("  will check {0}", os.path.abspath(p.rstrip(os.sep)), v=2)
                     self.extras.append(os.path.abspath(p.rstrip(os.sep)))
                 else:
-                    self.print("  {0} does not exist, cannot scan it.".format(os.path.abspath(p.rstrip(os.sep))), v=2)
+                    self.print("  {0} does not exist, cannot scan it.", os.path.abspath(p.rstrip(os.sep)), v=2)
 
     def add_to_exclusions(self, paths):
         if paths:
             for p in paths:
                 if os.path.exists(p):
-                    self.print("  will avoid {0}".format(os.path.abspath(p.rstrip(os.sep))), v=2)
+                    self.print("  will avoid {0}", os.path.abspath(p.rstrip(os.sep)), v=2)
                     self.exclusions.append(os.path.abspath(p.rstrip(os.sep)))
 
     def exclude_overlaps(self, extras, source):
         if extras:
             for e in extras:
                 real_e = os.path.abspath(e.rstrip(os.sep))
-                if os.path.exists(real_e) and source in real_e:
+                if os.path.exists(real_e) and matcher.path_within(real_e, source):
                     # You can search for dupes of extra folder within the tree of originals,
                     # e.g. Do the files in /home/pictures/extras/from_camera exist anywhere else in /home/pictures?
                     # In this case, we add /home/pictures/extras/from_camera as an exclusion, but only for the internal loops
-                    self.print("  will ignore {0} portion of {1}".format(real_e, source), v=2)
+                    self.print("  will ignore {0} portion of {1}", real_e, source, v=2)
                     self.overlaps.append(real_e)
 
-    def is_searchable_withmaps(self, path, check_overlaps=False):
-        if self.exclusions:
-            if True in map(lambda exclusion: exclusion in path, self.exclusions):
-                return False
-        if check_overlaps and self.overlaps:
-            if True in map(lambda exclusion: exclusion in path, self.overlaps):
-                return False
-        if True in map(lambda exclusion: exclusion in path, self.trash_dirs):
-            return False
-        return True
+    def compile_matchers(self):
+        """Compile exclusions and trash dirs, which prune the walk, and overlaps, which only filter originals."""
+        self.excluder = matcher.PathMatcher(self.exclusions, names=self.trash_dirs)
+        self.overlapper = matcher.PathMatcher(self.overlaps)
+
+    def overlaps_dir(self, path):
+        """Return True if directory path is within, or holds, any part of the tree being checked for extras."""
+        if self.overlapper.excludes(path):
+            return True
+        return True in [matcher.path_within(overlap, path) for overlap in self.overlaps]
 
     def is_searchable(self, path, check_overlaps=False):
-        if self.exclusions:
-            if True in [exclusion in path for exclusion in self.exclusions]:
-                return False
-        if check_overlaps and self.overlaps:
-            if True in [exclusion in path for exclusion in self.overlaps]:
-                return False
-        if self.trash_dirs:
-            if True in [exclusion in path for exclusion in self.trash_dirs]:
-                return False
+        if self.excluder is None:
+            self.compile_matchers()
+        if self.excluder.excludes(path):
+            return False
+        if check_overlaps and self.overlapper.excludes(path):
+            return False
         return True
 
+    def walk(self, path):
+        """Walk the tree at path into a DirNode, timing the walk and counting what it listed and stat'ed."""
+        rescanned = self.snapshot.num_rescanned_dirs if self.snapshot is not None else 0
+        with self.stats.timing('walk'):
+            d = nodes.DirNode(path, workers=self.walkers, excluder=self.excluder, snapshot=self.snapshot,
+                              deadline=self.deadline)
+        if self.snapshot is not None:
+            # Every directory's mtime is checked, but only changed directories are listed again.
+            self.stats.count('dirs_scanned', self.snapshot.num_rescanned_dirs - rescanned)
+            self.stats.count('stat_calls', d.num_walked_dirs)
+        else:
+            self.stats.count('dirs_scanned', d.num_walked_dirs)
+        self.stats.count('stat_calls', d.num_stat_calls)
+        return d
+
+    def count_comparisons(self, files_by_size):
+        """Count every file that shares its size with another, as only those are ever compared by content."""
+        self.stats.count('comparisons', sum([len(bucket) for bucket in files_by_size.values() if len(bucket) > 1]))
+
+    def tally_stats(self, search_seconds):
+        """Fill in what the hash pool and hash cache did, and attribute the rest of the search to grouping."""
+        if self.pool is not None:
+            self.stats.seconds['hash'] += self.pool.seconds
+            self.stats.count('files_hashed', sum(self.pool.num_hashed.values()))
+            self.stats.count('bytes_hashed', sum(self.pool.num_bytes.values()))
+            self.stats.devices.update(self.pool.device_report())
+        if self.hashdb is not None:
+            self.stats.count('cache_hits', self.hashdb.hits)
+        others = sum([self.stats.seconds[phase] for phase in ('walk', 'hash', 'report', 'remove', )])
+        self.stats.seconds['group'] += max(0.0, search_seconds - others)
+
     def search(self, orig, extras=[], excls=[], do_rm=False):
         self.last_run_start = time.time()
         self.real_orig = os.path.abspath(orig.rstrip(os.sep))
 
-        self.print("Searching for duplicate files in {0}...".format(self.real_orig), 5)
+        self.print("Searching for duplicate files in {0}...", self.real_orig, v=5)
 
         self.add_to_extras(extras)
         self.add_to_exclusions(excls)
         self.exclude_overlaps(extras, self.real_orig)
+        self.compile_matchers()
+        if self.checkpoint is not None:
+            # Stop as cleanly on a kill as on ^C, so there is always a checkpoint to resume from.
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            self.start_checkpoint({'cmd': 'remove' if do_rm else 'search', 'originals': self.real_orig,
+                                   'extras': self.extras, 'exclusions': self.exclusions})
+        # Sorted runs on disk stand in for listings in --max-memory mode, which never walks from a snapshot.
+        if self.snapshot_path is not None and self.max_memory is None:
+            self.load_snapshot()
+
+        self.searched = []
+        if self.time_budget is not None:
+            self.deadline = self.last_run_start + self.time_budget
+        configure_hashing(self.hash_algorithm, self.blocksize)
+        self.pool = hashpool.HashPool(jobs=self.jobs, progress=self.report_progress,
+                                      rotational_jobs=self.rotational_jobs)
+
+        try:
+            self.search_trees(extras, do_rm)
+        except (KeyboardInterrupt, TimeoutError) as e:
+            # Without a checkpoint, only running out of time is a clean stop; ^C still stops as it always has.
+            if self.checkpoint is None and isinstance(e, KeyboardInterrupt):
+                raise
+            self.stop(e)
+            return
+        self.tally_stats(time.time() - self.last_run_start)
+        self.save_hashes(self.searched)
+        self.save_snapshot(self.searched)
+        self.report_errors()
+        if self.dupelog is not None:
+            self.dupelog.close()
+            self.print("  logged {0}", self.dupelog, v=2)
+        self.last_run_end = time.time()
+        self.size_extras_dupes = self.reclaimable.bytes()
+        self.size_orig_dupes = self.matched.held_bytes()
+        self.print("{0} extra files found (out of {2} checked), consuming {1}", self.num_extras_dupes,
+            size_str(self.size_extras_dupes),
+            self.num_files_to_check, v=1)
+        self.print("    and they matched {0} protected files consuming {1}.", self.num_orig_dupes, size_str(self.size_orig_dupes), v=1)
+        if self.num_dir_dupes > 0:
+            self.print("    {0} duplicate directories found, consuming {1} beyond their first copies.", self.num_dir_dupes, size_str(self.dir_reclaimable.bytes()), v=1)
+        if self.num_hard_links > 0:
+            self.print("    {0} more matches were hard links to the same data, which removal would not free.", self.num_hard_links, v=1)
+        self.print("    in {0}", time_str(self.last_run_end - self.last_run_start), v=2)
+        for device, totals in self.stats.devices.items():
+            self.print("  device {0}{1}: hashed {2} in {3} files at {4}/s", device,
+                       " (spinning)" if totals['rotational'] else "", size_str(totals['bytes']), totals['files'],
+                       size_str(totals['bytes_per_second']), v=2)
+        if do_rm:
+            try:
+                with self.stats.timing('remove'):
+                    self.remove_queued()
+            except KeyboardInterrupt as e:
+                if self.checkpoint is None:
+                    raise
+                self.stop(e)
+                return
+            self.stats.count('files_unlinked', self.rmqueue.num_removed)
+            self.stats.count('bytes_unlinked', self.rmqueue.bytes_removed)
+            self.print("Removed {0} files in {1}", self.rmqueue.num_removed, time_str(time.time() - self.last_run_end), v=2)
+        if self.checkpoint is not None:
+            self.checkpoint.finish('complete')
+
+    def search_trees(self, extras=[], do_rm=False):
+        """Walk the originals and any extras, then find, report and queue for removal every duplicate."""
+        # Stream everything through sorted runs on disk, rather than holding whole trees in memory...
+        if self.max_memory is not None and os.path.isdir(self.real_orig):
+            self.search_external(do_rm)
 
         # Just find dupes in one directory...
-        if (extras == [] or extras is None) and os.path.isdir(self.real_orig):
-            self.print("Finding all duplicate files in {0}".format(self.real_orig), 3)
-            d = nodes.DirNode(self.real_orig)
+        elif (extras == [] or extras is None) and os.path.isdir(self.real_orig):
+            self.print("Finding all duplicate files in {0}", self.real_orig, v=3)
+            d = self.walk(self.real_orig)
+            self.load_hashes(d)
+            self.searched.append(d)
             self.num_files_to_check = d.total_files
-            self.print("  searching {0} nodes for {0} nodes".format(d.total_files), 1)
-            for f1 in d:
-                printed_1 = False
-                if self.is_searchable(f1.full_path):
-                    for f2 in d:
-                        if self.is_searchable(f2.full_path, check_overlaps=True):
-                            self.print("{0} vs {1}".format(f1, f2), v=4)
-                            if f1 != f2 and f1.compare(f2):
-                                if not printed_1:
-                                    # Only count and print the original file once, even if it matches repeatedly
-                                    self.print(f1, v=1)
-                                    printed_1 = True
-                                    self.num_extras_dupes += 1
-                                    self.size_extras_dupes += f1.size
-                                self.print("    == {0}".format(f2), v=1)
-                                self.num_orig_dupes += 1
-                                self.size_orig_dupes += f2.size
-                        else:
-                            self.print("{0} is not searchable.".format(f2.full_path), v=5)
+            self.count_comparisons(d.files_by_size)
+            self.print("  searching {0} nodes for {0} nodes", d.total_files, v=1)
+            # Whole duplicate directories are reported once, and only their first copy is searched file by file.
+            pruned = set()
+            for group in grouping.duplicate_dirs(d, pool=self.pool):
+                self.print(group[0], v=1)
+                self.log_dupes(group[:1], group[1:])
+                # Counted as report_dir_matches() counts them: the first copy is the original, the rest are extras.
+                self.num_orig_dupes += group[0].total_files
+                for f in group[0]:
+                    self.matched.add(f)
+                for other in group[1:]:
+                    self.print("    == {0}", other, v=1)
+                    self.num_dir_dupes += 1
+                    for f in other:
+                        self.num_extras_dupes += 1
+                        self.reclaimable.add(f)
+                        self.dir_reclaimable.add(f)
+                        pruned.add(id(f))
+            # Excluded subtrees were never walked. Only files sharing a size with at least one other file are ever
+            # hashed or compared, and overlaps only keep files from counting as somebody else's duplicate.
+            for f1, dupes, links in grouping.internal_dupes(d,
+                                                            keep_extra=lambda f: id(f) not in pruned,
+                                                            keep_orig=lambda f: id(f) not in pruned and not self.overlapper.excludes(f.full_path),
+                                                            pool=self.pool):
+                self.report_dupes(f1, dupes, links)
 
         # For each file in a target, find dupes in a source...
         elif os.path.isdir(self.real_orig):
-            d = nodes.DirNode(self.real_orig)
+            d = self.walk(self.real_orig)
+            self.load_hashes(d)
+            self.searched.append(d)
+            # The originals are indexed once, by size and by directory shape, and every target is looked up in them.
+            index = grouping.SizeIndex(d.files_by_size,
+                                       keep=lambda f: not self.overlapper.excludes(f.full_path),
+                                       pool=self.pool)
+            dir_index = grouping.DirIndex(d, keep=lambda sub: not self.overlaps_dir(sub.full_path), pool=self.pool)
             for t in self.extras:
-                self.print("Finding all duplicates of {0} in {1}".format(t, self.real_orig), 3)
+                self.print("Finding all duplicates of {0} in {1}", t, self.real_orig, v=3)
                 if os.path.isfile(t):
                     self.num_files_to_check += 1
-                    self.print("  searching {0} nodes for one file".format(d.total_files), 1)
+                    self.print("  searching {0} nodes for one file", d.total_files, v=1)
                     f1 = nodes.FileNode(t)
-                    printed_1 = False
+                    self.stats.count('stat_calls')
+                    self.load_hashes([f1, ])
+                    self.searched.append([f1, ])
                     if self.is_searchable(f1.full_path):
-                        for f2 in d:
-                            if self.is_searchable(f2.full_path, check_overlaps=True):
-                                self.print("{0} vs {1}".format(f1, f2), v=4)
-                                if f1.compare(f2):
-                                    # At this point, we have found a legitimate match and need to deal with it
-                                    if not printed_1:
-                                        self.print(f1, 1)
-                                        printed_1 = True
-                                        self.num_extras_dupes += 1
-                                        self.size_extras_dupes += f1.size
-                                    self.print("  = {0}".format(f2), v=1)
-                                    self.num_orig_dupes += 1
-                                    self.size_orig_dupes += f2.size
-                                    if do_rm:
-                                        self.rm(f1)
-                                else:
-                                    # print("    ", "miss on ", f2.node_name)
-                                    pass
-                            else:
-                                self.print("{0} is not searchable.".format(f2.full_path), v=5)
+                        self.stats.count('comparisons', 1 if f1.size in index.by_size else 0)
+                        index.prepare([f1, ])
+                        self.report_matches(f1, index.matches(f1), do_rm)
                     else:
-                        self.print("{0} is not searchable.".format(f1.full_path), v=3)
+                        self.print("{0} is not searchable.", f1.full_path, v=3)
                 elif os.path.isdir(t):
-                    # TODO: We are going to iterate over d numerous times. We should make a hash for quick lookup
-                    #       rather than full traversal of the tree. This could happen in-app, or be outsourced to a
-                    #       database like redis or postgresql. Hashing on an actual hash of each file's contents would be great,
-                    #       after it's done, but we only want to spend CPU hashing files we care about. So we will
-                    #       need to sort and index by size. A dictionary of lists, each list of files having equal
-                    #       size will speed things up enormously.
-                    td = nodes.DirNode(t)
+                    # A target inside the originals was walked along with them; reuse those nodes, and their hashes.
+                    td = d.find(t)
+                    if td is None:
+                        td = self.walk(t)
+                        self.load_hashes(td)
+                        self.searched.append(td)
                     self.num_files_to_check += td.total_files
-                    self.print("  checking {0} extra files against {1} protected files.".format(td.total_files, d.total_files), 1)
+                    self.print("  checking {0} extra files against {1} protected files.", td.total_files, d.total_files, v=1)
+                    # Whole subtrees of the target that the originals already hold are handled once, as directories.
+                    pruned = set()
+                    for sub, matches in dir_index.matches(td):
+                        self.report_dir_matches(sub, matches, do_rm)
+                        for f in sub:
+                            pruned.add(id(f))
+                    index.prepare([f1 for f1 in td if id(f1) not in pruned])
+                    self.stats.count('comparisons', len([f1 for f1 in td if id(f1) not in pruned and f1.size in index.by_size]))
                     for f1 in td:
-                        printed_1 = False
-                        if self.is_searchable(f1.full_path):
-                            for f2 in d:
-                                if self.is_searchable(f2.full_path, check_overlaps=True):
-                                    if f1.compare(f2):
-                                        # At this point, we have a legitimate match and need to deal with it
-                                        if not printed_1:
-                                            self.print(f1, v=1)
-                                            printed_1 = True
-                                            self.num_extras_dupes += 1
-                                            self.size_extras_dupes += f1.size
-                                        self.print("  = {0}".format(f2), v=1)
-                                        self.num_orig_dupes += 1
-                                        self.size_orig_dupes += f2.size
-                                        if do_rm:
-                                            self.rm(f1)
-                                else:
-                                    self.print("{0} is not searchable.".format(f2.full_path), v=5)
+                        if id(f1) not in pruned:
+                            self.report_matches(f1, index.matches(f1), do_rm)
+
+    def search_external(self, do_rm=False):
+        """Search as search() does, but never hold more than max_memory bytes of the trees' files at once.
+
+        Every file's size, path and stat are written to sorted runs on disk and merged back in order of size, and
+        only batches of same-size buckets ever become FileNodes, to be hashed and compared. Finding whole duplicate
+        directories needs whole trees in memory, so in this mode duplicates are only ever reported file by file.
+        Tallies are settled after each batch, and with --rmlog or --force_removal so are its removals, so memory
+        never grows with the number of duplicates found, either.
+        """
+        sorter = external.ExternalSorter(self.max_memory)
+        try:
+            with self.stats.timing('walk'):
+                for entry in external.walk_files(self.real_orig, self.excluder, self.walkers, stats=self.stats):
+                    self.tick()
+                    sorter.add(entry.path, entry.stat(), side=0)
+                num_originals = sorter.num_records
+                for t in self.extras:
+                    if os.path.isfile(t):
+                        if self.is_searchable(t):
+                            self.stats.count('stat_calls')
+                            sorter.add(t, os.stat(t), side=1)
                         else:
-                            self.print("{0} is not searchable.".format(f1.full_path), v=5)
+                            self.print("{0} is not searchable.", t, v=3)
+                    elif os.path.isdir(t):
+                        for entry in external.walk_files(t, self.excluder, self.walkers, stats=self.stats):
+                            self.tick()
+                            sorter.add(entry.path, entry.stat(), side=1)
+                sorter.flush()
+            self.num_files_to_check = sorter.num_records - num_originals if self.extras else num_originals
+            self.print("  sorted {0} files into {1} runs on disk", sorter.num_records, sorter.num_runs, v=2)
+            for originals, extras in sorter.batches():
+                self.load_hashes(list(originals) + list(extras))
+                if self.extras:
+                    index = grouping.SizeIndex(originals.files_by_size,
+                                               keep=lambda f: not self.overlapper.excludes(f.full_path),
+                                               pool=self.pool)
+                    index.prepare(list(extras))
+                    self.stats.count('comparisons', len([f1 for f1 in extras if f1.size in index.by_size]))
+                    for f1 in extras:
+                        self.report_matches(f1, index.matches(f1), do_rm)
+                else:
+                    self.count_comparisons(originals.files_by_size)
+                    for f1, dupes, links in grouping.internal_dupes(originals, pool=self.pool):
+                        self.report_dupes(f1, dupes, links)
+                self.save_hashes([originals, extras], quietly=True)
+                if self.hashdb is not None:
+                    self.hashdb.forget()
+                # Every name for an inode has the same size, so no later batch can add to what was tallied here.
+                self.reclaimable.settle()
+                self.matched.settle()
+                self.grouped.clear()
+                # Without a question to ask first, removals needn't wait for the search to finish, nor pile up.
+                if do_rm and (self.rmlog is not None or self.force_removal):
+                    with self.stats.timing('remove'):
+                        self.remove_queued()
+                    self.rmqueue.clear()
+        finally:
+            sorter.close()
+
+    def report_dupes(self, f1, dupes, links):
+        """Print and count the other copies, and hard links, of f1 within a single tree, once per group of copies.
+
+        f1 is the first of its group in the tree, so it is the one kept; every other copy counts as a duplicate.
+        Later members of the group are yielded again with f1 among their own dupes, and are skipped.
+        """
+        self.tick()
+        if id(f1) in self.grouped:
+            return
+        with self.stats.timing('report'):
+            self.grouped.update([id(f2) for f2 in dupes + links])
+            self.print(f1, v=1)
+            if dupes:
+                self.num_orig_dupes += 1
+                self.matched.add(f1)
+            self.log_dupes([f1, ], dupes, links)
+            for f2 in dupes:
+                self.print("    == {0}", f2, v=1)
+                self.num_extras_dupes += 1
+                self.reclaimable.add(f2)
+            for f2 in links:
+                # Hard links share one copy of the data, so there is nothing to free by removing them.
+                self.print("    -- {0} (hard link)", f2, v=1)
+                self.num_hard_links += 1
+
+    def report_matches(self, f1, matches, do_rm=False):
+        """Print and count the protected files matching extra file f1, queuing f1 for removal if requested.
+
+        Protected files that are hard links to f1 itself are listed apart from true copies. Removing f1 is still
+        safe, but the space it occupies is only counted if removing it would actually free that space.
+        """
+        self.tick()
+        # A file is never a copy of itself, even when it is reached from both trees.
+        matches = [f2 for f2 in matches if f2.full_path != f1.full_path]
+        if len(matches) == 0:
+            return
+        with self.stats.timing('report'):
+            # At this point, we have found a legitimate match and need to deal with it
+            self.print(f1, v=1)
+            self.num_extras_dupes += 1
+            self.reclaimable.add(f1)
+            self.log_dupes([f2 for f2 in matches if f2.inode_key() != f1.inode_key()], [f1, ],
+                           [f2 for f2 in matches if f2.inode_key() == f1.inode_key()])
+            for f2 in matches:
+                if f2.inode_key() == f1.inode_key():
+                    self.print("  - {0} (hard link)", f2, v=1)
+                    self.num_hard_links += 1
+                else:
+                    self.print("  = {0}", f2, v=1)
+                    self.num_orig_dupes += 1
+                    self.matched.add(f2)
+            if do_rm:
+                self.rm(f1, matches)
+
+    def report_dir_matches(self, sub, matches, do_rm=False):
+        """Print and count the protected directories identical to extra directory sub, queuing it for removal if requested."""
+        self.tick()
+        with self.stats.timing('report'):
+            self.print(sub, v=1)
+            self.num_dir_dupes += 1
+            for f in sub:
+                self.num_extras_dupes += 1
+                self.reclaimable.add(f)
+                self.dir_reclaimable.add(f)
+            self.log_dupes(matches, [sub, ])
+            for d in matches:
+                self.print("  = {0}", d, v=1)
+                self.num_orig_dupes += d.total_files
+                for f in d:
+                    self.matched.add(f)
+            if do_rm:
+                self.rm(sub, matches)
+
+    def serve(self, orig, excls=[], socket_path='~/.dupemgr/dupemgr.sock', refresh=300):
+        """Keep an index of orig in memory, answering lookups on socket_path and rewalking orig every refresh seconds."""
+        self.real_orig = os.path.abspath(orig.rstrip(os.sep))
+        self.add_to_exclusions(excls)
+        self.compile_matchers()
+        # Refreshes always rewalk from a snapshot; with --snapshot, so does the first walk.
+        self.load_snapshot()
+        configure_hashing(self.hash_algorithm, self.blocksize)
+        index_server = server.IndexServer(self.real_orig, socket_path, excluder=self.excluder, walkers=self.walkers,
+                                          jobs=self.jobs, refresh=refresh, prime=self.load_hashes,
+                                          report=lambda s: self.print("  {0}", s, v=2), snapshot=self.snapshot)
+        # Stop as cleanly on a kill as on ^C, so hashes are saved and the socket is removed either way.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            index_server.serve_forever()
+        except KeyboardInterrupt:
+            self.print("  stopped serving {0}", self.real_orig, v=2)
+        finally:
+            if index_server.root is not None:
+                self.save_hashes([index_server.root, ])
+                self.save_snapshot([index_server.root, ])
+
+    def query(self, extras, socket_path='~/.dupemgr/dupemgr.sock'):
+        """Ask a running server which indexed files duplicate each of extras, printing them like a search would."""
+        try:
+            reply = server.query(socket_path, {'op': 'lookup', 'paths': [os.path.abspath(p) for p in extras]})
+        except (FileNotFoundError, ConnectionRefusedError):
+            self.print("No dupemgr is serving {0}; start one with \"dupemgr serve\" first.", socket_path, v=0)
+            return None
+        for result in reply.get('results', []):
+            if result['error'] is not None:
+                self.print("{0}: {1}", result['path'], result['error'], v=1)
+            elif result['matches']:
+                self.print(result['path'], v=1)
+                for match in result['matches']:
+                    self.print("  = {0}", match, v=1)
+        return reply
+
+    def index(self, orig, excls=[], export_path=None, host=None):
+        """Hash every file in orig, caching hashes with --db, and export them as an index shard to export_path if given.
+
+        Files on another host can only be compared by their hashes, so every file is hashed in full, not just
+        those sharing a size with another file here. With --db, only new or changed files are ever read again.
+        """
+        self.last_run_start = time.time()
+        self.real_orig = os.path.abspath(orig.rstrip(os.sep))
+        self.add_to_exclusions(excls)
+        self.compile_matchers()
+        if self.snapshot_path is not None:
+            self.load_snapshot()
+        configure_hashing(self.hash_algorithm, self.blocksize)
+        self.pool = hashpool.HashPool(jobs=self.jobs, progress=self.report_progress,
+                                      rotational_jobs=self.rotational_jobs)
+        self.print("Indexing {0}", self.real_orig, v=3)
+        d = self.walk(self.real_orig)
+        self.load_hashes(d)
+        self.searched = [d, ]
+        self.pool.full(list(d))
+        self.tally_stats(time.time() - self.last_run_start)
+        self.save_hashes(self.searched)
+        self.save_snapshot(self.searched)
+        self.report_errors()
+        if export_path is not None:
+            host = host if host is not None else socket.gethostname()
+            shard = shards.Shard(export_path)
+            num_files = shard.write(d, host, self.real_orig)
+            self.print("Exported {0} files from {1}:{2} to {3}", num_files, host, self.real_orig, shard.shard_path, v=1)
         self.last_run_end = time.time()
-        self.print("{0} extra files found (out of {2} checked), consuming {1}".format(
-            self.num_extras_dupes,
-            size_str(self.size_extras_dupes),
-            self.num_files_to_check), 1)
-        self.print("    and they matched {0} protected files consuming {1}.".format(self.num_orig_dupes, size_str(self.size_orig_dupes)), 1)
-        self.print("    in {0}".format(time_str(self.last_run_end - self.last_run_start)), 2)
-        if do_rm:
-            self.remove_queued()
-            self.print("Removed {0} files in {1}".format(len(self.rmqueue), time_str(self.last_run_end - self.last_run_start)), 2)
+        self.print("    in {0}", time_str(self.last_run_end - self.last_run_start), v=2)
+
+    def merge(self, shard_paths):
+        """Report every group of files with the same size and hash found on more than one host, across shard_paths.
+
+        Shards are merged a record at a time, in order, so no file data ever moves and memory holds one group at a
+        time. The first copy of each group, by host and then path, is the one kept; the rest count as duplicates.
+        """
+        self.last_run_start = time.time()
+        merging = [shards.Shard(p) for p in shard_paths]
+        for shard in merging:
+            shard.read_header()
+            self.print("  merging {0}, {1} files hashed by {2}", shard, shard.header['files'],
+                       shard.header['algorithm'], v=2)
+        if len(set([shard.header['algorithm'] for shard in merging])) > 1:
+            self.print("  these shards were hashed by different algorithms, and files hashed differently never match.", v=1)
+        for group in shards.cross_host_groups(merging):
+            copies = {}
+            for f in group:
+                copies.setdefault(f.inode_key(), f)
+            dupes = [f for f in group[1:] if copies[f.inode_key()] is f]
+            links = [f for f in group[1:] if copies[f.inode_key()] is not f]
+            self.print(group[0], v=1)
+            self.log_dupes(group[:1], dupes, links)
+            self.num_orig_dupes += 1
+            self.num_extras_dupes += len(dupes)
+            self.size_extras_dupes += group[0].size * len(dupes)
+            for f2 in dupes:
+                self.print("    == {0}", f2, v=1)
+            for f2 in links:
+                # Hard links share one copy of the data, so there is nothing to free by removing them.
+                self.print("    -- {0} (hard link)", f2, v=1)
+                self.num_hard_links += 1
+        if self.dupelog is not None:
+            self.dupelog.close()
+            self.print("  logged {0}", self.dupelog, v=2)
+        self.last_run_end = time.time()
+        self.print("{0} groups of files are duplicated across hosts, with {1} extra copies consuming {2}",
+                   self.num_orig_dupes, self.num_extras_dupes, size_str(self.size_extras_dupes), v=1)
+        if self.num_hard_links > 0:
+            self.print("    {0} more were hard links to the same data, which removal would not free.", self.num_hard_links, v=1)
+        self.print("    in {0}", time_str(self.last_run_end - self.last_run_start), v=2)
 
     def remove(self, orig, extras=[], excls=[]):
-        self.print("Removing files from {0} with duplicates in {1}...".format(extras, orig), 5)
+        self.print("Removing files from {0} with duplicates in {1}...", extras, orig, v=5)
         return self.search(orig, extras, excls, do_rm=True)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+""" benchmark.py times dupemgr's walk, index, hash, search and remove phases on reproducible synthetic trees.
+    See README.md for usage examples.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+import DupeManagerApp
+import grouping
+import hashpool
+import localutils
+import nodes
+
+# Preset tree shapes, from a quick check to a full-scale run. Bigger trees get smaller files, to fit on a laptop.
+SHAPES = {
+    '1k': {'files': 1000, 'depth': 3, 'fanout': 4, 'sizes': 'mixed'},
+    '10k': {'files': 10000, 'depth': 4, 'fanout': 5, 'sizes': 'mixed'},
+    '100k': {'files': 100000, 'depth': 4, 'fanout': 8, 'sizes': 'small'},
+    '1m': {'files': 1000000, 'depth': 5, 'fanout': 10, 'sizes': 'tiny'},
+}
+
+# Log-normal size distributions, as (median bytes, sigma, largest bytes).
+SIZES = {
+    'tiny': (512, 1.0, 64 * 2 ** 10),
+    'small': (4 * 2 ** 10, 1.5, 2 ** 20),
+    'mixed': (32 * 2 ** 10, 2.0, 32 * 2 ** 20),
+    'large': (2 ** 20, 1.5, 256 * 2 ** 20),
+}
+
+
+def content(content_id, size, trap=False):
+    """Return size bytes unique to content_id, with the middle byte flipped if trap, so samples still collide."""
+    block = hashlib.sha256(str(content_id).encode('utf-8')).digest()
+    data = bytearray((block * (size // len(block) + 1))[:size])
+    if trap and size > 0:
+        data[size // 2] ^= 0xff
+    return data
+
+
+class TreeGenerator():
+    """Write a reproducible tree of originals, and a tree of incoming files to look up in them, beneath root.
+
+    Of the files written, a dupes fraction copy an earlier file's content, a traps fraction share an earlier file's
+    size and samples but differ in the middle, and a links fraction of originals are hard links to earlier originals.
+    An extras fraction of all files go to the incoming tree rather than the originals. The same seed always writes
+    the same tree.
+    """
+
+    def __init__(self, root, files=1000, depth=3, fanout=4, sizes='mixed', dupes=0.2, traps=0.05, links=0.02,
+                 extras=0.2, seed=0):
+        self.root = root
+        self.originals = os.path.join(root, 'originals')
+        self.incoming = os.path.join(root, 'incoming')
+        self.files = int(files)
+        self.depth = int(depth)
+        self.fanout = int(fanout)
+        self.sizes = sizes
+        self.dupes = float(dupes)
+        self.traps = float(traps)
+        self.links = float(links)
+        self.extras = float(extras)
+        self.seed = seed
+        self.counts = {'unique': 0, 'dupes': 0, 'traps': 0, 'links': 0, 'incoming': 0, 'bytes': 0}
+
+    def params(self):
+        return {'files': self.files, 'depth': self.depth, 'fanout': self.fanout, 'sizes': self.sizes,
+                'dupes': self.dupes, 'traps': self.traps, 'links': self.links, 'extras': self.extras,
+                'seed': self.seed}
+
+    def random_size(self, rng):
+        median, sigma, largest = SIZES[self.sizes]
+        return min(largest, max(1, int(rng.lognormvariate(0, sigma) * median)))
+
+    def random_dir(self, rng, tree):
+        parts = [tree, ] + ["d{0}".format(rng.randrange(self.fanout)) for _ in range(rng.randint(0, self.depth))]
+        return os.path.join(*parts)
+
+    def generate(self):
+        """Write every file, returning the counts of each kind written."""
+        rng = random.Random(self.seed)
+        written = []
+        originals = []
+        made = set()
+        for i in range(self.files):
+            tree = self.incoming if rng.random() < self.extras else self.originals
+            dir_path = self.random_dir(rng, tree)
+            if dir_path not in made:
+                os.makedirs(dir_path, exist_ok=True)
+                made.add(dir_path)
+            path = os.path.join(dir_path, "f{0:07d}".format(i))
+            roll = rng.random()
+            if tree == self.originals and originals and roll < self.links:
+                os.link(rng.choice(originals), path)
+                self.counts['links'] += 1
+                continue
+            elif written and roll < self.links + self.dupes:
+                _, content_id, size, trap = rng.choice(written)
+                self.counts['dupes'] += 1
+            elif written and roll < self.links + self.dupes + self.traps:
+                _, content_id, size, trap = rng.choice(written)
+                # A trap is always the base content with its middle flipped, so one drawn from a trap is its copy.
+                self.counts['dupes' if trap else 'traps'] += 1
+                trap = True
+            else:
+                content_id, size, trap = i, self.random_size(rng), False
+                self.counts['unique'] += 1
+            with open(path, 'wb') as f:
+                f.write(content(content_id, size, trap))
+            written.append((path, content_id, size, trap))
+            self.counts['bytes'] += size
+            if tree == self.incoming:
+                self.counts['incoming'] += 1
+            else:
+                originals.append(path)
+        os.makedirs(self.incoming, exist_ok=True)
+        return self.counts
+
+
+class Benchmark():
+    """Time each phase of finding, then removing, the incoming tree's duplicates among the originals."""
+
+    def __init__(self, generator, jobs=1, walkers=1, hash_algorithm='sha256', blocksize=None):
+        self.generator = generator
+        self.jobs = jobs
+        self.walkers = walkers
+        self.hash_algorithm = hash_algorithm
+        self.blocksize = blocksize
+        self.phases = {}
+
+    def timed(self, phase, fn, *args, **kwargs):
+        start = time.time()
+        result = fn(*args, **kwargs)
+        self.phases[phase] = {'seconds': time.time() - start}
+        return result
+
+    def run(self):
+        """Run every phase in order, on fresh nodes each time, returning the results as a dict."""
+        g = self.generator
+        counts = self.timed('generate', g.generate)
+        self.phases['generate'].update(counts)
+        localutils.configure_hashing(self.hash_algorithm, self.blocksize)
+
+        d = self.timed('walk', nodes.DirNode, g.originals, workers=self.walkers)
+        self.phases['walk'].update({'files': d.total_files, 'dirs': d.total_subdirs + 1})
+
+        index = self.timed('index', grouping.SizeIndex, d.files_by_size)
+        self.phases['index']['sizes'] = len(index.by_size)
+
+        # Hash every original in full, to measure raw hash256 throughput apart from any pruning by size or sample.
+        pool = hashpool.HashPool(jobs=self.jobs)
+        self.timed('hash', pool.full, list(d))
+        # Only bytes actually read count; files that vanish or can't be read add nothing.
+        self.phases['hash'].update({'files': pool.num_hashed['full'], 'bytes': pool.num_bytes['full'],
+                                    'mb_per_second': pool.num_bytes['full'] / 2 ** 20 / max(self.phases['hash']['seconds'], 1e-9)})
+
+        app = self.app()
+        self.timed('search', app.search, g.originals, [g.incoming, ])
+        self.phases['search'].update({'dupes': app.num_extras_dupes, 'hashed': app.pool.num_hashed['full']})
+
+        # Removing searches all over again, so the time spent unlinking is reported apart.
+        app = self.app()
+        app.force_removal = True
+        self.timed('remove', app.remove, g.originals, [g.incoming, ])
+        self.phases['remove'].update({'removed': app.rmqueue.num_removed, 'bytes': app.size_extras_dupes,
+                                      'unlink_seconds': time.time() - app.last_run_end})
+        return self.results()
+
+    def app(self):
+        # Below 0, not even the removal queue is printed.
+        app = DupeManagerApp.DupeManagerApp(verbosity=-1)
+        app.jobs = self.jobs
+        app.walkers = self.walkers
+        app.hash_algorithm = self.hash_algorithm
+        app.blocksize = self.blocksize
+        return app
+
+    def results(self):
+        return {
+            'commit': git_commit(),
+            'when': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'tree': self.generator.params(),
+            'options': {'jobs': self.jobs, 'walkers': self.walkers, 'hash': self.hash_algorithm,
+                        'blocksize': self.blocksize},
+            'phases': self.phases,
+        }
+
+
+def git_commit():
+    """Return the commit this checkout is at, or None outside of a git repository."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Print each phase's time next to the baseline's, as a ratio; below 1.0 is faster."""
+    print("phase       this run   {0:>10}   ratio".format(str(baseline.get('commit'))))
+    for phase, timing in results['phases'].items():
+        before = baseline.get('phases', {}).get(phase, {}).get('seconds')
+        if before:
+            print("{0:<10} {1:9.3f}s {2:9.3f}s   {3:.2f}".format(phase, timing['seconds'], before, timing['seconds'] / before))
+        else:
+            print("{0:<10} {1:9.3f}s {2:>10}".format(phase, timing['seconds'], '-'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shape", action="store", default='1k', choices=SHAPES.keys(),
+                        help="A preset tree, from 1k to 1m files. 1k is default.")
+    parser.add_argument("--files", action="store", default=None, help="How many files to write, overriding the shape.")
+    parser.add_argument("--depth", action="store", default=None, help="How deep directories may nest, overriding the shape.")
+    parser.add_argument("--fanout", action="store", default=None, help="How many subdirectories each may hold, overriding the shape.")
+    parser.add_argument("--sizes", action="store", default=None, choices=SIZES.keys(),
+                        help="The distribution of file sizes, overriding the shape.")
+    parser.add_argument("--dupes", action="store", default='0.2', help="The fraction of files copying another. 0.2 is default.")
+    parser.add_argument("--traps", action="store", default='0.05',
+                        help="The fraction of files the same size as another, differing only in the middle. 0.05 is default.")
+    parser.add_argument("--links", action="store", default='0.02', help="The fraction of originals hard linked to another. 0.02 is default.")
+    parser.add_argument("--extras", action="store", default='0.2', help="The fraction of files in the incoming tree. 0.2 is default.")
+    parser.add_argument("--seed", action="store", default='0', help="The random seed; the same seed writes the same tree.")
+    parser.add_argument("--jobs", action="store", default='1', help="The number of files to hash concurrently.")
+    parser.add_argument("--walkers", action="store", default='1', help="The number of directories to list concurrently.")
+    parser.add_argument("--hash", action="store", default='sha256', choices=localutils.HASH_ALGORITHMS,
+                        help="The hash algorithm to compare file contents with.")
+    parser.add_argument("--blocksize", action="store", default=None, help="How many bytes to read at a time while hashing, like 65536, 256k or 1M.")
+    parser.add_argument("--dir", action="store", default=None,
+                        help="Where to write the tree, which must not exist yet. A temporary directory is default.")
+    parser.add_argument("--keep", action="store_true", help="Leave the tree on disk afterward.")
+    parser.add_argument("--out", action="store", default=None, help="Save results to this JSON file.")
+    parser.add_argument("--compare", action="store", default=None, help="Compare results to those saved in this JSON file.")
+    args = parser.parse_args()
+
+    shape = dict(SHAPES[args.shape])
+    for key in ['files', 'depth', 'fanout', 'sizes']:
+        if getattr(args, key) is not None:
+            shape[key] = getattr(args, key)
+    root = args.dir if args.dir is not None else tempfile.mkdtemp(prefix='dupemgr-bench-')
+    generator = TreeGenerator(root, dupes=args.dupes, traps=args.traps, links=args.links, extras=args.extras,
+                              seed=int(args.seed), **shape)
+    bench = Benchmark(generator, jobs=int(args.jobs), walkers=int(args.walkers), hash_algorithm=args.hash,
+                      blocksize=localutils.parse_size(args.blocksize) if args.blocksize is not None else None)
+    try:
+        results = bench.run()
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    for phase, timing in results['phases'].items():
+        print("{0:<10} {1:9.3f}s  {2}".format(phase, timing['seconds'],
+                                              ", ".join(["{0} {1}".format(k, round(v, 2) if isinstance(v, float) else v)
+                                                         for k, v in timing.items() if k != 'seconds'])))
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Saved results to {0}".format(args.out))
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
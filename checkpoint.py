@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+""" Checkpoint keeps what an interrupted run needs to pick up where it stopped: its hashes, listings and removals. """
+
+import json
+import os
+import time
+
+import nodes
+import snapshot
+
+
+def file_record(f):
+    """Return what snapshot.Entry needs to stand in for FileNode f, as a list that survives JSON."""
+    return [f.node_path, f.node_name, f.size, f.created, f.modified, f.device, f.inode, f.links]
+
+
+class Checkpoint():
+    """A directory holding the state of one run, saved every so often and whenever the run is stopped.
+
+    Hashes go to a HashDB and directory listings to a Snapshot, both kept in this directory unless the run already
+    has its own, so a resumed run neither rehashes a file nor lists a directory that hasn't changed since. The
+    removals still pending are kept with the stats of every file involved, so that on resume nothing is removed if
+    it, or every original it matched, has changed since it was first compared. state.json says which run it all
+    belongs to, and whether that run finished; only an unfinished run with the same arguments is ever resumed.
+    """
+
+    version = 1
+
+    def __init__(self, checkpoint_dir, every=300):
+        """Keep state in checkpoint_dir, saving it at most every few seconds while the run goes on."""
+        self.checkpoint_dir = os.path.abspath(os.path.expanduser(checkpoint_dir))
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        self.every = float(every)
+        self.last_saved = time.time()
+        self.state_path = os.path.join(self.checkpoint_dir, 'state.json')
+        self.removals_path = os.path.join(self.checkpoint_dir, 'removals.jsonl')
+        self.hashdb_path = os.path.join(self.checkpoint_dir, 'hashes.db')
+        self.snapshot_path = os.path.join(self.checkpoint_dir, 'snapshot.jsonl.gz')
+        self.run = None
+
+    def __str__(self):
+        return self.checkpoint_dir
+
+    def state(self):
+        """Return the state last saved, or None if there is none."""
+        if not os.path.isfile(self.state_path):
+            return None
+        with open(self.state_path) as state_file:
+            return json.load(state_file)
+
+    def write_state(self, status):
+        with open(self.state_path + ".tmp", 'w') as state_file:
+            json.dump({'version': self.version, 'run': self.run, 'status': status, 'saved': time.time()}, state_file)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def start(self, run, resume=False):
+        """Start checkpointing run, a dict of its arguments, returning True if it resumes where it last stopped.
+
+        Unless resuming that same unfinished run, the pending removals, hashes and listings left from another run
+        are all forgotten. A listing reused from a snapshot keeps the stats its files had then, so a file rewritten
+        in place since, in a directory that didn't otherwise change, would look unchanged, and keep its old hash.
+        """
+        self.run = run
+        state = self.state()
+        resumed = (resume and state is not None and state.get('version') == self.version
+                   and state.get('run') == run and state.get('status') != 'complete')
+        if not resumed:
+            for path in (self.removals_path, self.hashdb_path, self.snapshot_path):
+                if os.path.isfile(path):
+                    os.remove(path)
+        self.write_state('running')
+        self.last_saved = time.time()
+        return resumed
+
+    def due(self):
+        """Return True if it has been long enough since the last save to save again."""
+        return time.time() - self.last_saved >= self.every
+
+    def save_removals(self, rmqueue):
+        """Write every queued removal, with the stats of its files and of the originals it matched."""
+        with open(self.removals_path + ".tmp", 'w') as removals_file:
+            for node in rmqueue:
+                originals = rmqueue.originals.get(node.full_path, [])
+                removals_file.write(json.dumps({
+                    'path': node.full_path,
+                    'files': [file_record(f) for f in rmqueue.files([node, ])],
+                    'originals': [[file_record(f) for f in rmqueue.files([original, ])] for original in originals],
+                }) + "\n")
+        os.replace(self.removals_path + ".tmp", self.removals_path)
+
+    def load_removals(self):
+        """Return [(node, [originals]), ...] for every removal saved, as they were when they were compared.
+
+        A queued directory comes back as a DirNode holding just the files that were compared beneath it, and files
+        that are already gone, perhaps removed before the run stopped, are left out.
+        """
+        removals = []
+        if not os.path.isfile(self.removals_path):
+            return removals
+        with open(self.removals_path) as removals_file:
+            for line in removals_file:
+                record = json.loads(line)
+                node = self.restore(record['path'], record['files'])
+                if node is not None:
+                    removals.append((node, [self.restore(None, files) for files in record['originals']]))
+        return removals
+
+    def restore(self, path, records):
+        """Rebuild a FileNode, or a DirNode of FileNodes, from file records, or return None if they are all gone."""
+        entries = [snapshot.Entry(*record) for record in records if os.path.lexists(os.path.join(record[0], record[1]))]
+        if path is not None and len(entries) == 0:
+            return None
+        if len(records) == 1 and (path is None or path == os.path.join(records[0][0], records[0][1])):
+            return nodes.FileNode(snapshot.Entry(*records[0]))
+        d = nodes.DirNode(path if path is not None else os.path.commonpath([r[0] for r in records]), do_walk=False)
+        d.expand([], entries if path is not None else [snapshot.Entry(*record) for record in records])
+        return d
+
+    def finish(self, status):
+        """Record that the run stopped early, and can resume, or that it is complete, with nothing left pending."""
+        if status == 'complete' and os.path.isfile(self.removals_path):
+            os.remove(self.removals_path)
+        self.write_state(status)
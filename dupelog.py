@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+""" DupeLog streams each group of duplicates to a JSON-lines or CSV file as soon as it is found. """
+
+import csv
+import json
+
+import nodes
+
+
+class DupeLog():
+    """A results file written one duplicate group at a time, and flushed after each, so other tools can follow it.
+
+    Each group has a kind ('file' or 'dir'), the size and digest its members share, the protected copies that are
+    kept, the duplicates that could go, and any hard links to the same data, which removing would not free.
+    JSON-lines files hold one group per line. CSV files hold one row per path, tied together by a group number.
+    """
+
+    csv_columns = ['group', 'kind', 'role', 'path', 'size', 'digest']
+
+    def __init__(self, log_path, fmt=None):
+        """Open log_path for writing, as 'csv' if fmt says so or the file name ends in .csv, otherwise as 'jsonl'."""
+        self.log_path = log_path
+        if fmt is None:
+            fmt = 'csv' if log_path.lower().endswith('.csv') else 'jsonl'
+        if fmt not in ('jsonl', 'csv'):
+            raise ValueError("A dupelog can be written as jsonl or csv, not {0}".format(fmt))
+        self.fmt = fmt
+        self.num_groups = 0
+        self.log_file = open(log_path, 'w', newline='')
+        self.writer = None
+        if self.fmt == 'csv':
+            self.writer = csv.writer(self.log_file)
+            self.writer.writerow(self.csv_columns)
+            self.log_file.flush()
+
+    def __str__(self):
+        return "{0} ({1} groups)".format(self.log_path, self.num_groups)
+
+    def write(self, keep, dupes, links=None):
+        """Write one group: the kept nodes, and the FileNodes or DirNodes that duplicate them."""
+        first = keep[0] if keep else dupes[0]
+        if isinstance(first, nodes.DirNode):
+            kind, size, digest = 'dir', first.total_bytes, first.tree_digest()
+        else:
+            kind, size, digest = 'file', first.size, first.sha256
+        roles = [('protected', keep), ('duplicate', dupes), ('hard_link', links if links else [])]
+        self.num_groups += 1
+        if self.fmt == 'csv':
+            for role, members in roles:
+                for node in members:
+                    self.writer.writerow([self.num_groups, kind, role, node.full_path, size, digest])
+        else:
+            record = {'group': self.num_groups, 'kind': kind, 'size': size, 'digest': digest}
+            for role, members in roles:
+                record[role] = [node.full_path for node in members]
+            self.log_file.write(json.dumps(record) + "\n")
+        self.log_file.flush()
+
+    def close(self):
+        self.log_file.close()
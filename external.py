@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+""" ExternalSorter finds same-size files in trees too large to hold in memory, by sorting their records on disk. """
+
+import collections
+import concurrent.futures
+import heapq
+import json
+import os
+import shutil
+import tempfile
+
+import nodes
+import snapshot
+
+# A rough cost of each record held in memory, beyond the length of its path, for keeping within --max-memory.
+RECORD_BYTES = 200
+
+# A FileNode, with its hashes, costs about this much while its size bucket is being compared.
+NODE_BYTES = 600
+
+# Never merge more runs than this at once, so a huge scan can't run out of file handles.
+MERGE_WIDTH = 64
+
+
+def walk_files(path, excluder=None, workers=1, stats=None):
+    """Yield an already stat'ed os.DirEntry for every file beneath path, holding only the directories still to list.
+
+    Like DirNode.walk, up to workers directories are listed at once and excluded entries are never stat'ed, but
+    nothing walked is kept: each file is handed on as soon as its directory has been listed. Directories listed
+    and files stat'ed are counted in stats, a stats.RunStats, if given.
+    """
+    queue = collections.deque()
+    if excluder:
+        state = excluder.start(path)
+        if state is not True:
+            queue.append((path, state))
+    else:
+        queue.append((path, None))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, int(workers))) as executor:
+        pending = {}
+        while queue or pending:
+            while queue and len(pending) < max(1, int(workers)):
+                dir_path, state = queue.popleft()
+                keep = excluder.keeper(state) if excluder else None
+                pending[executor.submit(nodes.scan_dir, dir_path, keep)] = state
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                state = pending.pop(future)
+                dirs, entries = future.result()
+                if stats is not None:
+                    stats.count('dirs_scanned')
+                    stats.count('stat_calls', len(entries))
+                for dir_path in dirs:
+                    queue.append((dir_path, excluder.step(state, os.path.basename(dir_path)) if excluder else None))
+                yield from entries
+
+
+class Batch():
+    """A few size buckets of FileNodes at a time, standing in for the DirNode that grouping expects."""
+
+    def __init__(self):
+        self.files_by_size = {}
+        self.num_files = 0
+
+    def __len__(self):
+        return self.num_files
+
+    def __iter__(self):
+        for bucket in self.files_by_size.values():
+            yield from bucket
+
+    def add(self, files):
+        self.files_by_size.setdefault(files[0].size, []).extend(files)
+        self.num_files += len(files)
+
+
+class ExternalSorter():
+    """Collect (size, side, path, stat) records into sorted runs on disk, then merge them back in order of size.
+
+    Records are buffered until they would take about half of max_memory, then sorted and written out as one run.
+    Merging reads every run at once, a line at a time, so memory only ever holds the buffer, one line per run,
+    and the size bucket being handed out. side tells originals (0) from the extras looked up in them (1).
+    """
+
+    def __init__(self, max_memory, tmpdir=None):
+        """Prepare to sort within max_memory bytes, writing runs beneath tmpdir, or the system's temp directory."""
+        self.max_memory = int(max_memory)
+        self.run_dir = tempfile.mkdtemp(prefix='dupemgr-', dir=tmpdir)
+        self.runs = []
+        self.num_runs = 0
+        self.buffer = []
+        self.buffered = 0
+        self.num_records = 0
+
+    def add(self, path, fstat, side=0):
+        """Buffer one file's path and stat, writing out a run whenever the buffer is full."""
+        self.buffer.append((fstat.st_size, side, path, fstat.st_ctime, fstat.st_mtime, fstat.st_dev,
+                            fstat.st_ino, fstat.st_nlink))
+        self.buffered += RECORD_BYTES + len(path)
+        self.num_records += 1
+        if self.buffered >= self.max_memory // 2:
+            self.flush()
+
+    def flush(self):
+        """Sort whatever is buffered and write it out as one more run."""
+        if self.buffer:
+            self.buffer.sort()
+            self.runs.append(self.write_run(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def write_run(self, records):
+        self.num_runs += 1
+        run_path = os.path.join(self.run_dir, "run{0:06d}.jsonl".format(self.num_runs))
+        with open(run_path, 'w') as run_file:
+            for record in records:
+                run_file.write(json.dumps(record) + "\n")
+        return run_path
+
+    def read_run(self, run_path):
+        with open(run_path) as run_file:
+            for line in run_file:
+                yield tuple(json.loads(line))
+
+    def merged(self):
+        """Yield every record in order of size, first merging runs in passes if there are too many to open at once."""
+        self.flush()
+        while len(self.runs) > MERGE_WIDTH:
+            runs, self.runs = self.runs[:MERGE_WIDTH], self.runs[MERGE_WIDTH:]
+            self.runs.append(self.write_run(heapq.merge(*[self.read_run(r) for r in runs])))
+            for run_path in runs:
+                os.remove(run_path)
+        yield from heapq.merge(*[self.read_run(r) for r in self.runs])
+
+    def buckets(self):
+        """Yield the [(side, FileNode), ...] sharing each size, for every size shared by more than one file."""
+        size = None
+        records = []
+        for record in self.merged():
+            if record[0] != size:
+                if len(records) > 1:
+                    yield [self.node(r) for r in records]
+                size = record[0]
+                records = []
+            records.append(record)
+        if len(records) > 1:
+            yield [self.node(r) for r in records]
+
+    def node(self, record):
+        """Return (side, FileNode) for a record, without going back to the filesystem."""
+        size, side, path, created, modified, device, inode, links = record
+        f = nodes.FileNode(snapshot.Entry(os.path.dirname(path), os.path.basename(path), size, created, modified,
+                                          device, inode, links))
+        return side, f
+
+    def batches(self):
+        """Yield (originals, extras) Batches of whole size buckets, each holding about a quarter of max_memory in FileNodes."""
+        originals = Batch()
+        extras = Batch()
+        for sided in self.buckets():
+            origs = [f for side, f in sided if side == 0]
+            if origs:
+                originals.add(origs)
+            others = [f for side, f in sided if side != 0]
+            if others:
+                extras.add(others)
+            if (len(originals) + len(extras)) * NODE_BYTES >= self.max_memory // 4:
+                yield originals, extras
+                originals = Batch()
+                extras = Batch()
+        if len(originals) + len(extras) > 0:
+            yield originals, extras
+
+    def close(self):
+        """Remove every run from disk."""
+        shutil.rmtree(self.run_dir, ignore_errors=True)
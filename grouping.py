@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+""" Grouping functions narrow trees of FileNodes down to the few files that could possibly be duplicates. """
+
+import hashpool
+
+
+def sample_buckets(files):
+    """Return a dictionary of lists of same-size files keyed by a hash of each file's head and tail, skipping unreadable files."""
+    buckets = {}
+    for f in files:
+        key = f.sample_hash()
+        if key is None:
+            # Unreadable files never match anything.
+            continue
+        if key in buckets:
+            buckets[key].append(f)
+        else:
+            buckets[key] = [f, ]
+    return buckets
+
+
+def hash_buckets(files):
+    """Return a dictionary of lists of same-size files keyed by full content hash, hashing each file at most once."""
+    buckets = {}
+    for f in files:
+        key = f.full_hash()
+        if key is None:
+            # Unreadable files never match anything.
+            continue
+        if key in buckets:
+            buckets[key].append(f)
+        else:
+            buckets[key] = [f, ]
+    return buckets
+
+
+def internal_dupes(root, keep_extra=None, keep_orig=None, pool=None):
+    """Yield (file, [duplicates], [hard links]) for every file in root sharing its content elsewhere in root.
+
+    Only size buckets with two or more members are ever sampled, and only files whose head and tail samples
+    collide are ever hashed in full, each tier as one batch through the HashPool. Hard links to the same inode
+    need no hashing at all, and are reported apart from true copies. Files are yielded in the same order as
+    iterating over root, and their duplicates in the same order within each bucket, so output matches a full
+    pairwise scan.
+    keep_extra filters the files we look for dupes of; keep_orig filters the files that may count as their dupes.
+    """
+    if pool is None:
+        pool = hashpool.HashPool()
+
+    # Find the size buckets that could possibly hold a pair, noting hard links as we go, and sample them.
+    candidates = []
+    links = {}
+    for size, bucket in root.files_by_size.items():
+        if len(bucket) < 2:
+            continue
+        extras = [f for f in bucket if keep_extra is None or keep_extra(f)]
+        origs = [f for f in bucket if keep_orig is None or keep_orig(f)]
+        if len(extras) == 0 or len(origs) == 0:
+            continue
+        by_inode = {}
+        for f2 in origs:
+            by_inode.setdefault(f2.inode_key(), []).append(f2)
+        for f1 in extras:
+            linked = [f2 for f2 in by_inode.get(f1.inode_key(), []) if f2 is not f1]
+            if linked:
+                links[id(f1)] = linked
+        if len(set([f.inode_key() for f in extras + origs])) > 1:
+            candidates.append((extras, origs))
+    pool.sample([f for extras, origs in candidates for f in extras + origs])
+
+    # Fully hash only the files whose samples collide with some other inode's.
+    collisions = []
+    for extras, origs in candidates:
+        by_sample = sample_buckets(origs)
+        for f1 in extras:
+            peers = [f2 for f2 in by_sample.get(f1.sample256, []) if f2.inode_key() != f1.inode_key()]
+            if peers:
+                collisions.append((f1, peers))
+    pool.full([f for f1, peers in collisions for f in [f1, ] + peers])
+
+    matches = {}
+    for f1, peers in collisions:
+        dupes = [f2 for f2 in peers if f1.sha256 is not None and f2.sha256 == f1.sha256]
+        if dupes:
+            matches[id(f1)] = dupes
+    if matches or links:
+        for f1 in root:
+            if id(f1) in matches or id(f1) in links:
+                yield f1, matches.get(id(f1), []), links.get(id(f1), [])
+
+
+class Reclaimable():
+    """Tally the bytes that removing a set of file names would actually free.
+
+    Each inode counts once, and only if every one of its hard links is in the set; otherwise its data survives.
+    Once every name an inode will ever have has been added, settle() folds it into running totals, so the tally
+    needn't grow with the number of files added.
+    """
+
+    def __init__(self):
+        self.inodes = {}
+        self.settled = {'names': 0, 'bytes': 0, 'held_bytes': 0}
+
+    def add(self, f):
+        key = f.inode_key()
+        if key in self.inodes:
+            self.inodes[key][1].add(f.full_path)
+        else:
+            self.inodes[key] = [f, set([f.full_path, ])]
+
+    def settle(self):
+        """Fold every inode added so far into the running totals, and forget it; none may be added to again."""
+        self.settled['names'] = len(self)
+        self.settled['bytes'] = self.bytes()
+        self.settled['held_bytes'] = self.held_bytes()
+        self.inodes = {}
+
+    def __len__(self):
+        return self.settled['names'] + sum([len(names) for f, names in self.inodes.values()])
+
+    def bytes(self):
+        return self.settled['bytes'] + sum([f.size for f, names in self.inodes.values() if len(names) >= max(1, f.links)])
+
+    def held_bytes(self):
+        """Return the bytes the names in the set occupy on disk, counting each inode once, however many it has."""
+        return self.settled['held_bytes'] + sum([f.size for f, names in self.inodes.values()])
+
+
+class SizeIndex():
+    """Index a tree of originals by size, sampling and hashing each bucket only when something its size is looked up."""
+
+    def __init__(self, files_by_size, keep=None, pool=None):
+        """Build the index from a DirNode's files_by_size dictionary, keeping only files that pass keep(f)."""
+        self.pool = pool if pool is not None else hashpool.HashPool()
+        self.by_size = {}
+        self.by_sample = {}
+        self.by_hash = {}
+        for size, bucket in files_by_size.items():
+            kept = [f for f in bucket if keep is None or keep(f)]
+            if kept:
+                self.by_size[size] = kept
+
+    def __len__(self):
+        return sum([len(bucket) for bucket in self.by_size.values()])
+
+    def adopt(self, other, touched):
+        """Take over another index's sample and hash buckets for every size not in touched, rather than rebuilding them.
+
+        other must index an earlier walk of the same tree, and touched must hold every size whose files changed since.
+        Lookups may still be adding buckets to other, so its buckets are copied out before they are gone through.
+        """
+        for size, buckets in list(other.by_sample.items()):
+            if size in self.by_size and size not in touched:
+                self.by_sample[size] = buckets
+        for key, buckets in list(other.by_hash.items()):
+            if key[0] in self.by_size and key[0] not in touched:
+                self.by_hash[key] = buckets
+
+    def prepare(self, files):
+        """Hash, in two concurrent batches, everything that looking up each of files would otherwise hash one by one."""
+        files = [f for f in files if f.size in self.by_size]
+        sizes = set([f.size for f in files])
+        self.pool.sample(files + [f2 for size in sizes for f2 in self.by_size[size]])
+        full = []
+        queued = set()
+        for f1 in files:
+            if f1.size not in self.by_sample:
+                self.by_sample[f1.size] = sample_buckets(self.by_size[f1.size])
+            if f1.sample256 is not None and f1.sample256 in self.by_sample[f1.size]:
+                full.append(f1)
+                if (f1.size, f1.sample256) not in queued:
+                    queued.add((f1.size, f1.sample256))
+                    full.extend(self.by_sample[f1.size][f1.sample256])
+        self.pool.full(full)
+
+    def matches(self, the_file):
+        """Return the list of indexed files with the same content as the_file, in index order."""
+        if the_file.size not in self.by_size:
+            return []
+        if the_file.size not in self.by_sample:
+            self.by_sample[the_file.size] = sample_buckets(self.by_size[the_file.size])
+        key = (the_file.size, the_file.sample_hash())
+        if key[1] not in self.by_sample[the_file.size]:
+            return []
+        if key not in self.by_hash:
+            self.by_hash[key] = hash_buckets(self.by_sample[the_file.size][key[1]])
+        return self.by_hash[key].get(the_file.full_hash(), [])
+
+
+def confirm_dirs(groups, pool=None):
+    """Split groups of same-shape directories by sampled, then full, content digests, keeping groups of two or more.
+
+    Every file beneath every directory is sampled as one batch, and only directories whose sampled digests still
+    collide have their files hashed in full.
+    """
+    if pool is None:
+        pool = hashpool.HashPool()
+    for tier in ['sample256', 'sha256']:
+        # Nested candidates share files, so gather each directory beneath any of them only once.
+        beneath = {}
+        for group in groups:
+            for d in group:
+                if id(d) not in beneath:
+                    for sub in d.subtree():
+                        beneath[id(sub)] = sub
+        files = [f for sub in beneath.values() for f in sub.files]
+        if tier == 'sample256':
+            pool.sample(files)
+        else:
+            pool.full(files)
+        split = []
+        for group in groups:
+            by_digest = {}
+            for d in group:
+                digest = d.tree_digest(tier)
+                if digest is not None:
+                    by_digest.setdefault(digest, []).append(d)
+            split.extend([same for same in by_digest.values() if len(same) > 1])
+        groups = split
+    return groups
+
+
+def distinct_copies(group):
+    """Return group without any directory that is only hard links to the files of one before it, in the same places.
+
+    Linked trees, like rsnapshot's, share their data rather than copying it, so they are left to the file by file
+    search, which reports them as hard links without reading a byte.
+    """
+    inodes = set()
+    kept = []
+    for d in group:
+        if d.tree_digest('inode') not in inodes:
+            inodes.add(d.tree_digest('inode'))
+            kept.append(d)
+    return kept
+
+
+def duplicate_dirs(root, keep=None, pool=None):
+    """Return groups of two or more identical, non-empty directories within root, parents before children.
+
+    A group is left out when every one of its members sits inside a directory that is itself duplicated, as
+    its parents' group already covers it.
+    """
+    by_shape = {}
+    for d in root.subtree():
+        if d.total_files > 0 and (keep is None or keep(d)):
+            by_shape.setdefault(d.tree_digest('shape'), []).append(d)
+    groups = [distinct_copies(group) for group in by_shape.values() if len(group) > 1]
+    groups = confirm_dirs([group for group in groups if len(group) > 1], pool)
+    duplicated = set([id(d) for group in groups for d in group])
+    return [group for group in groups
+            if not all([d.parent is not None and id(d.parent) in duplicated for d in group])]
+
+
+class DirIndex():
+    """Index the directories of a tree of originals by shape, to find whole subtrees of a target they already hold."""
+
+    def __init__(self, root, keep=None, pool=None):
+        """Index every non-empty directory beneath root that passes keep(d)."""
+        self.pool = pool if pool is not None else hashpool.HashPool()
+        self.by_shape = {}
+        for d in root.subtree():
+            if d.total_files > 0 and (keep is None or keep(d)):
+                self.by_shape.setdefault(d.tree_digest('shape'), []).append(d)
+
+    def matches(self, target):
+        """Return [(target dir, [identical indexed dirs]), ...] for the largest subtrees of target already indexed."""
+        candidates = [t for t in target.subtree() if t.total_files > 0 and t.tree_digest('shape') in self.by_shape]
+        is_target = set([id(t) for t in candidates])
+        # Indexed dirs that are only hard links to a target dir, or that are the very same dir, are no copies of it.
+        groups = [[t, ] + [d for d in self.by_shape[t.digests['shape']]
+                           if d.full_path != t.full_path and d.tree_digest('inode') != t.tree_digest('inode')]
+                  for t in candidates]
+        found = {}
+        # Each group starts with exactly one target dir, so each confirmed group holds at most one.
+        for group in confirm_dirs([group for group in groups if len(group) > 1], self.pool):
+            for t in [d for d in group if id(d) in is_target]:
+                found[id(t)] = (t, [d for d in group if id(d) not in is_target])
+        matched = []
+        stack = [target, ]
+        while stack:
+            node = stack.pop()
+            if id(node) in found:
+                matched.append(found[id(node)])
+            else:
+                stack.extend(reversed(node.subdirs))
+        return matched
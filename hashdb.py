@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+""" HashDB keeps file hashes in a local sqlite database so repeat runs only rehash new or changed files. """
+
+import os
+import socket
+import sqlite3
+
+# Support functions for this package are defined in localutils.py
+from localutils import *
+
+
+class HashDB():
+    """A persistent cache of FileNode records, keyed by path and trusted only while size, mtime and inode still match.
+
+    Digests are stored tagged with their algorithm, and never handed back to a run using a different one.
+    """
+
+    columns = ['name', 'path', 'size', 'host', 'created', 'modified', 'tabled', 'inode', 'sample256', 'sha256']
+
+    def __init__(self, dbfile, host=None):
+        """Open (or create) the sqlite database at dbfile."""
+        self.dbfile = os.path.abspath(os.path.expanduser(dbfile))
+        self.host = host if host is not None else socket.gethostname()
+        if not os.path.isdir(os.path.dirname(self.dbfile)):
+            os.makedirs(os.path.dirname(self.dbfile))
+        self.conn = sqlite3.connect(self.dbfile)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS files (
+            name TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            host TEXT,
+            created REAL,
+            modified REAL NOT NULL,
+            tabled TEXT,
+            inode INTEGER,
+            sample256 TEXT,
+            sha256 TEXT,
+            PRIMARY KEY (path, name)
+        )""")
+        self.conn.commit()
+        # Remember what we loaded so we only write back hashes that are new.
+        self.loaded = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return "{0} ({1} hits, {2} misses)".format(self.dbfile, self.hits, self.misses)
+
+    def fresh(self, row, f):
+        """Return True if a cached row still describes FileNode f, and holds digests from the algorithm in use."""
+        if row is None or row[0] != f.size or row[1] != f.modified or row[2] != f.inode:
+            return False
+        digest = row[4] if row[4] is not None else row[3]
+        return digest_algorithm(digest) == HASHING['algorithm']
+
+    def prime(self, files):
+        """Fill in cached hashes on each FileNode whose size, mtime and inode are unchanged since it was hashed."""
+        for f in files:
+            row = self.conn.execute(
+                "SELECT size, modified, inode, sample256, sha256 FROM files WHERE path = ? AND name = ?",
+                (f.node_path, f.node_name)).fetchone()
+            if self.fresh(row, f):
+                if f.sample256 is None:
+                    f.sample256 = row[3]
+                if f.sha256 is None:
+                    f.sha256 = row[4]
+                self.loaded[f.full_path] = (row[3], row[4])
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def save(self, files):
+        """Write every new or changed hash from files back to the database."""
+        records = []
+        for f in files:
+            if f.sample256 is None and f.sha256 is None:
+                continue
+            if self.loaded.get(f.full_path) == (f.sample256, f.sha256):
+                continue
+            record = f.as_dict(self.host)
+            records.append(tuple([record[c] for c in self.columns]))
+            self.loaded[f.full_path] = (f.sample256, f.sha256)
+        if records:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files ({0}) VALUES ({1})".format(
+                    ", ".join(self.columns), ", ".join(["?"] * len(self.columns))),
+                records)
+            self.conn.commit()
+        return len(records)
+
+    def forget(self):
+        """Forget which hashes were loaded or saved so far, once none of those files will be saved again."""
+        self.loaded = {}
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+""" HashPool hashes batches of FileNodes concurrently, one tier at a time, and one queue per device. """
+
+import concurrent.futures
+import os
+import time
+
+from localutils import SAMPLE_BYTES
+
+
+# Reading more than one file at a time from a spinning disk only makes its heads seek between them.
+ROTATIONAL_JOBS = 1
+
+
+def is_rotational(device):
+    """Return True if st_dev device is a spinning disk, False if it is not, or None if the platform can't say."""
+    if not device or not hasattr(os, 'major'):
+        return None
+    block = "/sys/dev/block/{0}:{1}".format(os.major(device), os.minor(device))
+    # A partition has no queue of its own; its whole disk, one directory up, does.
+    for queue in [os.path.join(block, 'queue'), os.path.join(block, '..', 'queue')]:
+        try:
+            with open(os.path.join(queue, 'rotational')) as rotational:
+                return rotational.read().strip() == '1'
+        except OSError:
+            continue
+    return None
+
+
+class HashPool():
+    """Hash a batch of files with worker threads, reporting progress and collecting unreadable files.
+
+    hashlib releases the GIL while it digests large buffers, so threads keep both disks and cores busy without
+    the cost of shipping FileNodes to other processes. Each device gets its own queue and workers, so a slow disk
+    never holds up a fast one, and each queue is read in inode order, which on most filesystems is close to the
+    order of the data on disk. Spinning disks get only rotational_jobs workers, however many jobs are allowed.
+    """
+
+    def __init__(self, jobs=1, progress=None, rotational_jobs=ROTATIONAL_JOBS):
+        """Prepare up to jobs workers per device. progress(tier, done, total) is called on the calling thread."""
+        self.jobs = max(1, int(jobs))
+        self.rotational_jobs = max(1, int(rotational_jobs))
+        self.progress = progress
+        self.errors = []
+        self.num_hashed = {'sample': 0, 'full': 0}
+        self.num_bytes = {'sample': 0, 'full': 0}
+        self.seconds = 0.0
+        # Per device: whether it spins, and how many files and bytes it has had read in how many seconds
+        self.devices = {}
+
+    def sample(self, files):
+        """Fill in sample256 on every file in the batch that still lacks one."""
+        return self.run('sample', [f for f in files if f.sample256 is None], lambda f: f.sample_hash())
+
+    def full(self, files):
+        """Fill in sha256 on every file in the batch that still lacks one."""
+        return self.run('full', [f for f in files if f.sha256 is None], lambda f: f.full_hash())
+
+    def device(self, device):
+        """Return the running totals for device, first checking whether it spins."""
+        if device not in self.devices:
+            self.devices[device] = {'rotational': is_rotational(device), 'files': 0, 'bytes': 0, 'seconds': 0.0}
+        return self.devices[device]
+
+    def device_jobs(self, device):
+        """Return how many files may be read from device at once."""
+        if self.device(device)['rotational']:
+            return min(self.jobs, self.rotational_jobs)
+        return self.jobs
+
+    def run(self, tier, files, hasher):
+        """Apply hasher once per distinct, not yet failed, inode, returning the number of files actually read.
+
+        Hard links share one inode, so only the first name of each is read; the rest receive its digests.
+        """
+        todo = {}
+        links = {}
+        for f in files:
+            if f.hash_error is not None:
+                continue
+            key = f.inode_key()
+            if key not in todo:
+                todo[key] = f
+            elif todo[key] is not f:
+                links.setdefault(key, []).append(f)
+        if len(todo) == 0:
+            return 0
+        by_device = {}
+        for f in todo.values():
+            by_device.setdefault(f.device, []).append(f)
+        for queue in by_device.values():
+            queue.sort(key=lambda f: f.inode or 0)
+        start = time.time()
+        finished = {}
+        if len(todo) == 1 or (len(by_device) == 1 and self.device_jobs(list(by_device.keys())[0]) == 1):
+            queue = [f for queue in by_device.values() for f in queue]
+            self.collect(tier, len(todo), ((f, hasher(f)) for f in queue), finished)
+        else:
+            executors = dict([(device, concurrent.futures.ThreadPoolExecutor(max_workers=self.device_jobs(device)))
+                              for device in by_device])
+            futures = {}
+            try:
+                for device, queue in by_device.items():
+                    for f in queue:
+                        futures[executors[device].submit(hasher, f)] = f
+                self.collect(tier, len(todo), ((futures[future], future.result())
+                                               for future in concurrent.futures.as_completed(futures)), finished)
+            finally:
+                # If collecting stopped early, don't wait for files nobody has started reading.
+                for future in futures:
+                    future.cancel()
+                for executor in executors.values():
+                    executor.shutdown()
+        self.seconds += time.time() - start
+        for device, done_at in finished.items():
+            self.device(device)['seconds'] += done_at - start
+        for key, f in todo.items():
+            for link in links.get(key, []):
+                if link.sample256 is None:
+                    link.sample256 = f.sample256
+                if link.sha256 is None:
+                    link.sha256 = f.sha256
+                link.hash_error = f.hash_error
+        return len(todo)
+
+    def collect(self, tier, total, results, finished):
+        """Consume (file, digest) pairs as workers finish them, recording failures, throughput and progress."""
+        for done, (f, digest) in enumerate(results, start=1):
+            self.num_hashed[tier] += 1
+            totals = self.device(f.device)
+            totals['files'] += 1
+            finished[f.device] = time.time()
+            if digest is None:
+                self.errors.append(f)
+            else:
+                num_bytes = 2 * SAMPLE_BYTES if tier == 'sample' and f.size > 2 * SAMPLE_BYTES else f.size
+                self.num_bytes[tier] += num_bytes
+                totals['bytes'] += num_bytes
+            if self.progress is not None:
+                self.progress(tier, done, total)
+
+    def device_report(self):
+        """Return each device's totals, and its throughput in bytes per second, keyed by 'major:minor'."""
+        report = {}
+        for device, totals in self.devices.items():
+            name = "{0}:{1}".format(os.major(device), os.minor(device)) if device and hasattr(os, 'major') else str(device)
+            report[name] = dict(totals, bytes_per_second=totals['bytes'] / totals['seconds'] if totals['seconds'] else 0.0)
+        return report
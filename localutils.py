@@ -3,8 +3,47 @@
 """ Utility functions to assist the dupemgr app """
 
 import hashlib
+import mmap
+import os
 
-import nodes
+# Files larger than two samples get a cheap head/tail sample hash before anyone reads them in full.
+SAMPLE_BYTES = 4096
+
+# Algorithms --hash may choose from. sha1 and md5 are fine for finding duplicates, but not for anything adversarial.
+HASH_ALGORITHMS = ('sha256', 'blake2b', 'blake2s', 'sha1', 'md5', )
+
+# How every hash in this run is computed. Change it with configure_hashing(), before anything is hashed.
+HASHING = {
+    'algorithm': 'sha256',
+    'blocksize': 262144,
+    # Files at least this large are hashed straight from a memory map rather than read into a buffer.
+    'mmap_bytes': 64 * 2 ** 20,
+}
+
+
+def configure_hashing(algorithm=None, blocksize=None):
+    """Choose the digest algorithm and read block size for every hash computed from now on."""
+    if algorithm is not None:
+        if algorithm not in HASH_ALGORITHMS:
+            raise ValueError("{0} is not one of the supported hash algorithms, {1}".format(
+                algorithm, ", ".join(HASH_ALGORITHMS)))
+        HASHING['algorithm'] = algorithm
+    if blocksize is not None:
+        if int(blocksize) < 1:
+            raise ValueError("The hash block size must be a positive number of bytes, not {0}".format(blocksize))
+        HASHING['blocksize'] = int(blocksize)
+
+
+def tag_digest(hasher):
+    """Return the hasher's hex digest labelled with its algorithm, so digests from different algorithms never match."""
+    return "{0}:{1}".format(hasher.name, hasher.hexdigest())
+
+
+def digest_algorithm(digest):
+    """Return the algorithm a tagged digest was computed with, or None for an untagged or missing digest."""
+    if digest is None or ':' not in digest:
+        return None
+    return digest.split(':', 1)[0]
 
 
 def short_hash(hash, chars=11):
@@ -12,26 +51,61 @@ def short_hash(hash, chars=11):
     ch_ea = int((chars - 3) / 2)
     if hash is None:
         return ("0" * ch_ea) + "..." + ("0" * ch_ea)
+    hash = hash.split(':')[-1]
     return hash[:ch_ea] + "..." + hash[(-1 * ch_ea):]
 
 
-def hash256(the_file, blocksize=32768, force=False):
-    """Return the sha256 hash of the file provided."""
+def hash256(the_file, blocksize=None, force=False):
+    """Return the tagged digest of the file provided, by the configured algorithm, raising OSError if it cannot be read.
+
+    The name is historical; HASHING['algorithm'] decides the digest. Reads reuse a single buffer, and very large
+    files are hashed from a memory map, so no new bytes objects are made per block.
+    """
     if not force and the_file.sha256 is not None:
         # If we already have a hash, use it.
         return the_file.sha256
+    if blocksize is None:
+        blocksize = HASHING['blocksize']
     # We only do the expensive job of hashing if it doesn't exist, or we're asked to force it.
-    try:
-        with open(the_file.full_path, 'rb') as f:
-            hasher = hashlib.sha256()
+    # An unreadable file raises OSError rather than returning a None that could "match" another None.
+    hasher = hashlib.new(HASHING['algorithm'])
+    with open(the_file.full_path, 'rb', buffering=0) as f:
+        # Decide by the size the file has now, not when it was walked; an empty file can't be mapped at all.
+        if os.fstat(f.fileno()).st_size >= max(1, HASHING['mmap_bytes']):
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                view = memoryview(m)
+                for offset in range(0, len(m), blocksize):
+                    hasher.update(view[offset:offset + blocksize])
+                view.release()
+        else:
+            buf = bytearray(blocksize)
+            view = memoryview(buf)
             while True:
-                buf = f.read(blocksize)
-                if not buf:
+                n = f.readinto(buf)
+                if not n:
                     break
-                hasher.update(buf)
-    except:
-        return None
-    return hasher.hexdigest()
+                hasher.update(view[:n])
+    return tag_digest(hasher)
+
+
+def hash_sample(the_file, samplesize=SAMPLE_BYTES, force=False):
+    """Return the tagged digest of only the first and last samplesize bytes of the file provided."""
+    if not force and the_file.sample256 is not None:
+        # If we already have a sample hash, use it.
+        return the_file.sample256
+    with open(the_file.full_path, 'rb') as f:
+        hasher = hashlib.new(HASHING['algorithm'])
+        hasher.update(f.read(samplesize))
+        f.seek(max(0, the_file.size - samplesize))
+        hasher.update(f.read(samplesize))
+    return tag_digest(hasher)
+
+
+def hash_entries(entries):
+    """Return the tagged digest of a list of tuples, such as the sorted entries of a directory."""
+    hasher = hashlib.new(HASHING['algorithm'])
+    hasher.update(repr(entries).encode('utf-8', 'surrogateescape'))
+    return tag_digest(hasher)
 
 
 def size_str(num):
@@ -46,6 +120,28 @@ def size_str(num):
         return "%d bytes" % num
 
 
+def parse_size(size):
+    """Interpret a size like 512, 64k, 200MB or 4G as a number of bytes."""
+    units = {'': 1, 'k': 2 ** 10, 'm': 2 ** 20, 'g': 2 ** 30, 't': 2 ** 40}
+    digits = str(size).strip().lower().rstrip('b').rstrip('i')
+    unit = digits[-1:] if digits[-1:] in units else ''
+    try:
+        return int(float(digits[:len(digits) - len(unit)]) * units[unit])
+    except ValueError:
+        raise ValueError("{0} is not a size, like 512, 64k, 200MB or 4G".format(size))
+
+
+def parse_time(duration):
+    """Interpret a duration like 90, 90s, 45m or 6h as a number of seconds."""
+    units = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    digits = str(duration).strip().lower()
+    unit = digits[-1:] if digits[-1:] in units else ''
+    try:
+        return float(digits[:len(digits) - len(unit)]) * units[unit]
+    except ValueError:
+        raise ValueError("{0} is not a duration, like 90, 90s, 45m or 6h".format(duration))
+
+
 def time_str(num):
     """Stringify a number of seconds in human-friendly terms."""
     if num > 3600:
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+""" PathMatcher decides, one path component at a time, whether a path falls under an excluded subtree. """
+
+import fnmatch
+import os
+import re
+
+
+def path_parts(path):
+    """Return the components of the absolute, normalized form of path."""
+    return [part for part in os.path.abspath(path).split(os.sep) if part]
+
+
+def path_within(path, root):
+    """Return True if path is root, or anything beneath it, comparing whole components rather than substrings."""
+    parts = path_parts(path)
+    root_parts = path_parts(root)
+    return parts[:len(root_parts)] == root_parts
+
+
+# Characters that make an excluded name a shell-style pattern rather than a literal name.
+GLOB_CHARS = re.compile(r'[*?\[]')
+
+
+class PathMatcher():
+    """A trie of excluded paths, plus directory names (like .Trash or .Trash-*) excluded wherever they appear.
+
+    Matching is by whole path component, so excluding /data/photos never excludes /data/photos2. A walk can
+    carry a state from each directory to its entries with step(), paying one dictionary lookup per entry
+    instead of testing every exclusion against every full path.
+    """
+
+    def __init__(self, paths=None, names=None):
+        """Compile the excluded paths and names. Paths are made absolute; names match any single component.
+
+        A name holding shell wildcards, like .Trash-*, matches every component it fits, by fnmatch rules.
+        """
+        self.trie = {}
+        self.names = set([n for n in names if not GLOB_CHARS.search(n)]) if names else set()
+        patterns = [fnmatch.translate(n) for n in names if GLOB_CHARS.search(n)] if names else []
+        self.patterns = re.compile("|".join(patterns)) if patterns else None
+        if paths:
+            for p in paths:
+                self.add(p)
+
+    def __bool__(self):
+        return len(self.trie) > 0 or len(self.names) > 0 or self.patterns is not None
+
+    def add(self, path):
+        """Exclude path and everything beneath it."""
+        node = self.trie
+        parts = path_parts(path)
+        for part in parts[:-1]:
+            if node.get(part) is True:
+                # Something above this path is already excluded.
+                return
+            node = node.setdefault(part, {})
+        if parts:
+            node[parts[-1]] = True
+
+    def step(self, state, name):
+        """Return the state for entry name within a directory whose state is given.
+
+        True means excluded. A dict means some exclusion may still lie beneath. None means only names can match.
+        """
+        if name in self.names:
+            return True
+        if self.patterns is not None and self.patterns.match(name):
+            return True
+        if state is True:
+            return True
+        if state is None:
+            return None
+        return state.get(name)
+
+    def keeper(self, state):
+        """Return a function of an entry name, True if that entry of a directory with this state is not excluded."""
+        def keep(name):
+            return self.step(state, name) is not True
+        return keep
+
+    def start(self, path):
+        """Return the state for path itself, from which a walk beneath it can step()."""
+        state = self.trie
+        for part in path_parts(path):
+            state = self.step(state, part)
+            if state is True:
+                return True
+        return state
+
+    def excludes(self, path):
+        """Return True if path falls under any exclusion."""
+        return self.start(path) is True
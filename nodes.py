@@ -2,6 +2,8 @@
 
 """ Node classes, FileNode and DirNode, represent directory trees and files within """
 
+import collections
+import concurrent.futures
 import os
 import time
 
@@ -12,47 +14,56 @@ from localutils import *
 class BaseNode():
     """A base class for all filesystem objects (dirs and files) to inherit from."""
 
+    __slots__ = ('full_path', 'parent', )
+
     def __init__(self, path, parent=None):
         """Initialize the node with a name and a path."""
         self.full_path = os.path.normpath(path.rstrip(os.sep))
-        self.node_name = os.path.basename(self.full_path)
-        self.node_path = os.path.dirname(self.full_path)
         self.parent = parent
 
+    @property
+    def node_name(self):
+        """The last component of the path, derived on demand rather than stored with every node."""
+        return os.path.basename(self.full_path)
+
+    @property
+    def node_path(self):
+        """The directory containing this node, derived on demand rather than stored with every node."""
+        return os.path.dirname(self.full_path)
+
     def __str__(self):
         """Stringification of node, just name for now"""
         return self.node_name
 
 
 class FileNode(BaseNode):
-    """Maintain information about a file node"""
+    """Maintain information about a file node
+
+    Trees can hold tens of millions of these, so they use __slots__ rather than a per-instance __dict__, keep
+    times as plain floats, and stat each file exactly once.
+    """
+
+    __slots__ = ('size', 'created', 'modified', 'device', 'inode', 'links', 'tabled', 'sample256', 'sha256',
+                 'hash_error', )
 
     def __init__(self, path, parent=None):
-        """Initialize the FileNode with actual filesystem data based on the path provided."""
-        if isinstance(path, str) and os.path.isfile(path):
+        """Initialize the FileNode from a path string, or from an os.DirEntry whose cached stat we can reuse."""
+        if isinstance(path, str):
             BaseNode.__init__(self, path, parent)
             fstat = os.stat(self.full_path)
-            self.size = int(fstat.st_size)
-            # self.size = os.path.getsize(self.full_path)
-            # self.created = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(fstat.st_ctime))
-            self.created = os.path.getctime(self.full_path)
-            # self.modified = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(fstat.st_mtime))
-            self.modified = os.path.getmtime(self.full_path)
-            # self.tabled = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
-            self.tabled = time.localtime()
-            self.sha256 = None
-            # print("        String   -> \"{0}\"".format(self.__str__()))
         else:
             BaseNode.__init__(self, path.path, parent)
-            self.size = path.stat().st_size
-            self.created = path.stat().st_ctime
-            self.modified = path.stat().st_mtime
-            self.tabled = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-            self.sha256 = None
-            # print("        DirEntry -> \"{0}\"".format(self.__str__()) )
-            # else:
-            # print("        FAIL: got \"{0}\" as {1}, but could not find the file.".format(path, type(path)))
-            # pass
+            fstat = path.stat()
+        self.size = fstat.st_size
+        self.created = fstat.st_ctime
+        self.modified = fstat.st_mtime
+        self.device = fstat.st_dev
+        self.inode = fstat.st_ino
+        self.links = fstat.st_nlink
+        self.tabled = time.time()
+        self.sample256 = None
+        self.sha256 = None
+        self.hash_error = None
 
     def __str__(self):
         """Provide a string representation of the important file details"""
@@ -70,23 +81,62 @@ class FileNode(BaseNode):
             'host': host,
             'created': self.created,
             'modified': self.modified,
-            'tabled': self.tabled,
+            'tabled': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.tabled)),
+            'inode': self.inode,
+            'sample256': self.sample256,
             'sha256': self.sha256,
         }
 
     def signature(self):
-        self.sha256 = hash256(self, force=False)
-        return "{0:16}-{1}".format(self.size, self.sha256)
+        return "{0:16}-{1}".format(self.size, self.full_hash())
+
+    def inode_key(self):
+        """Return a key shared by every hard link to this file's data, or unique to this node if inodes are unknown."""
+        if self.inode:
+            return (self.device, self.inode)
+        return id(self)
+
+    def sample_hash(self):
+        """Return a hash of the head and tail of this file, reading it at most once, or None if it can't be read."""
+        if self.sample256 is None and self.hash_error is None:
+            try:
+                if self.size <= 2 * SAMPLE_BYTES:
+                    # A small file's sample would cover the whole file anyway, so hash it fully, just once.
+                    self.sha256 = hash256(self, force=False)
+                    self.sample256 = self.sha256
+                else:
+                    self.sample256 = hash_sample(self, force=False)
+            except OSError as e:
+                self.hash_error = e
+        return self.sample256
+
+    def full_hash(self):
+        """Return a hash of the entire contents of this file, reading it at most once, or None if it can't be read."""
+        if self.sha256 is None and self.hash_error is None:
+            try:
+                self.sha256 = hash256(self, force=False)
+            except OSError as e:
+                self.hash_error = e
+        return self.sha256
+
+    def changed(self):
+        """Return True if the file on disk no longer has the size, mtime and inode this node recorded, or is gone."""
+        try:
+            fstat = os.stat(self.full_path)
+        except OSError:
+            return True
+        return (fstat.st_size, fstat.st_mtime, fstat.st_ino) != (self.size, self.modified, self.inode)
 
     def compare(self, other_file):
         """Compare self file to another provided file, returning "match" "content" or False."""
         if self.size == other_file.size:
             # Hashing is expensive and hashes don't matter unless filesizes match, so don't even bother unless we're already matched on size.
-            # Even so, if hashing is already done, localutils.hash256 only hashes on None hashes unless force=True
-            # We really only want to do this once, and only if necessary.
-            self.sha256 = hash256(self, force=False)
-            other_file.sha256 = hash256(other_file, force=False)
-            if self.sha256 == other_file.sha256:
+            # Even then, same-size files that differ in their first or last few kB never need to be read in full.
+            # Each tier's hash is kept on the node, so we really only do this once per file, and only if necessary.
+            # A file we could not read never matches anything, not even another unreadable file.
+            if self.sample_hash() is None or self.sample_hash() != other_file.sample_hash():
+                return False
+            if self.full_hash() is not None and self.full_hash() == other_file.full_hash():
                 if self.node_name == other_file.node_name:
                     return "match"
                 else:
@@ -94,15 +144,43 @@ class FileNode(BaseNode):
         return False
 
 
+def scan_dir(path, keep=None):
+    """List one directory, returning its subdirectory paths and its file entries, with each file already stat'ed.
+
+    This is the only part of a walk that touches the filesystem, so it is what runs concurrently in DirNode.walk.
+    Entries whose names fail keep(name) are dropped before they are ever stat'ed or descended into.
+    """
+    dirs = []
+    files = []
+    with os.scandir(path) as it:
+        # it yields os.DirEntry objects with name, path, is_dir(), is_file(), stat() members
+        for entry in it:
+            if keep is not None and not keep(entry.name):
+                continue
+            if entry.is_dir():
+                dirs.append(entry.path)
+            elif entry.is_file():
+                # DirEntry caches its stat, so FileNode won't go back to the filesystem for it.
+                entry.stat()
+                files.append(entry)
+    return dirs, files
+
+
 class DirNode(BaseNode):
     """Maintain information about a directory node."""
 
-    def __init__(self, path, parent=None, do_walk=True, do_hidden=False, depth=0, make_size_dict=False):
-        """Initialize a directory node"""
+    def __init__(self, path, parent=None, do_walk=True, do_hidden=False, depth=0, make_size_dict=False, workers=1,
+                 excluder=None, snapshot=None, deadline=None):
+        """Initialize a directory node, walking the whole tree beneath it with workers concurrent scandir calls.
+
+        Subtrees excluded by excluder, a matcher.PathMatcher, are never listed or stat'ed. Directories unchanged
+        since they were recorded in snapshot, a snapshot.Snapshot, are listed from it instead. A walk still going
+        at deadline, a time.time(), raises TimeoutError.
+        """
         BaseNode.__init__(self, path, parent)
 
         # Initialize counters and sums
-        self.depth = 0
+        self.depth = depth
         self.subdirs = []
         self.files = []
         self.files_by_size = {}
@@ -114,99 +192,150 @@ class DirNode(BaseNode):
         self.total_files = 0
         self.total_bytes = 0
         self.expanded = False
+        # What walking this node cost: directories listed, and files stat'ed rather than listed from a snapshot
+        self.num_walked_dirs = 0
+        self.num_stat_calls = 0
+        # Digests of the whole subtree, by tier: 'shape' (names and sizes), 'inode' (names, sizes and inodes),
+        # 'sample256' and 'sha256' (contents)
+        self.digests = {}
 
         # Walk the directory if requested and existent
         if do_walk and os.path.isdir(path):
-            it = os.scandir(path)
-            # it is an os.DirEntry object with name, path, is_dir(), is_file(), stat() members
-            for entry in it:
-                if entry.is_dir():
-                    # print("    {0}[ {1} ]".format( "".ljust(depth*2), entry.name ))
-                    self.num_subdirs += 1
-                    if do_walk:
-                        # Create the node first, triggering a walk, then use its contents.
-                        the_dir = DirNode(entry.path, parent=self, depth=depth + 1)
-                        self.subdirs.append(the_dir)
-                        self.merge_dicts(the_dir.files_by_size)
-                elif entry.is_file():
-                    # print("    {0} ({1} bytes)".format( entry.path, entry.stat().st_size ))
-                    self.num_files += 1
-                    the_file = FileNode(entry)
-                    self.bytes += the_file.size
-                    # Stick the file in our simple list
-                    self.files.append(FileNode(entry))
-                    # and stick the file in our size-indexed dictionary
-                    if the_file.size in self.files_by_size:
-                        self.files_by_size[the_file.size].append(the_file)
-                    else:
-                        self.files_by_size[the_file.size] = [the_file, ]
-            self.total_files += self.num_files
-            self.total_subdirs += self.num_subdirs
-            self.total_bytes += self.bytes
-            self.expanded = True
-            if self.parent:
-                # print("--update parent {0}--".format(parent.node_name))
-                self.parent.total_subdirs += self.total_subdirs
-                self.parent.total_files += self.total_files
-                self.parent.total_bytes += self.total_bytes
-            else:
-                # print("--no parent to update--")
-                pass
-        else:
-            print("Either do_walk was set to False, or \"{0}\" is not a directory.".format(path))
+            self.walk(workers, excluder, snapshot, deadline)
+        elif do_walk:
+            print("\"{0}\" is not a directory.".format(path))
 
-            # print("{0} initialized with {1}/{2} subdirs, {3}/{4} files, using {5}/{6} bytes".format(
-            #     self.full_path,
-            #     self.num_subdirs, self.total_subdirs,
-            #     self.num_files, self.total_files,
-            #     self.bytes, self.total_bytes))
+    def walk(self, workers=1, excluder=None, snapshot=None, deadline=None):
+        """Walk the tree beneath this node from an explicit queue of directories, never recursing.
 
-    def __iter__(self):
-        return DirIterator(self)
+        Up to workers directories are listed at once. Their contents are turned into nodes on this thread, totals
+        are summed bottom-up once the walk is done, and only this node gets a files_by_size index of the whole
+        tree, built in iteration order. Each queued directory carries its excluder state, so deciding whether an
+        entry is excluded costs one step() on its name. With a snapshot, each directory is listed by its scan().
+        """
+        scan = snapshot.scan if snapshot is not None else scan_dir
+        walked = []
+        queue = collections.deque()
+        if excluder:
+            state = excluder.start(self.full_path)
+            if state is not True:
+                queue.append((self, state))
+        else:
+            queue.append((self, None))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, int(workers))) as executor:
+            pending = {}
+            while queue or pending:
+                if deadline is not None and time.time() > deadline:
+                    raise TimeoutError("ran out of time walking {0}".format(self.full_path))
+                while queue and len(pending) < max(1, int(workers)):
+                    node, state = queue.popleft()
+                    keep = excluder.keeper(state) if excluder else None
+                    pending[executor.submit(scan, node.full_path, keep)] = (node, state)
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    node, state = pending.pop(future)
+                    dirs, entries = future.result()
+                    node.expand(dirs, entries)
+                    walked.append(node)
+                    self.num_stat_calls += len([e for e in entries if isinstance(e, os.DirEntry)])
+                    for subdir in node.subdirs:
+                        queue.append((subdir, excluder.step(state, subdir.node_name) if excluder else None))
 
-    def __reversed__(self):
-        return DirIterator(self)
+        self.num_walked_dirs = len(walked)
 
-    def __str__(self):
-        return "{0} ({2} in {1} files)".format(self.full_path, self.total_files, size_str(self.total_bytes))
+        # Every directory was walked after its parent, so summing in reverse adds each subtree up exactly once.
+        for node in reversed(walked):
+            node.total_files += node.num_files
+            node.total_subdirs += node.num_subdirs
+            node.total_bytes += node.bytes
+            if node.parent is not None:
+                node.parent.total_subdirs += node.total_subdirs
+                node.parent.total_files += node.total_files
+                node.parent.total_bytes += node.total_bytes
 
-    def merge_dicts(self, new_dict):
-        for size_key in new_dict:
-            if size_key in self.files_by_size:
-                self.files_by_size[size_key] = self.files_by_size[size_key] + new_dict[size_key]
+        # Index files in iteration order, so each size list is in the same order as iterating over this node.
+        self.files_by_size = {}
+        for the_file in self:
+            if the_file.size in self.files_by_size:
+                self.files_by_size[the_file.size].append(the_file)
             else:
-                self.files_by_size[size_key] = new_dict[size_key]
+                self.files_by_size[the_file.size] = [the_file, ]
 
+    def expand(self, dirs, entries):
+        """Fill this node with the subdirectories and files found by scan_dir, without walking any further."""
+        for dir_path in dirs:
+            self.num_subdirs += 1
+            self.subdirs.append(DirNode(dir_path, parent=self, do_walk=False, depth=self.depth + 1))
+        for entry in entries:
+            self.num_files += 1
+            the_file = FileNode(entry)
+            self.bytes += the_file.size
+            self.files.append(the_file)
+        self.expanded = True
 
-class DirIterator():
-    def __init__(self, parent):
-        self.parent = parent
-        self.count = 0
-        self.idx = 0
-        self.it = None
+    def subtree(self):
+        """Return this node and every directory beneath it, parents before children, without recursing."""
+        nodes = []
+        stack = [self, ]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(reversed(node.subdirs))
+        return nodes
+
+    def tree_digest(self, tier='sha256'):
+        """Return a Merkle digest of this whole subtree, built bottom-up from its files and subdirectories.
+
+        The 'shape' tier summarizes only names and sizes, and needs no file reads; two directories can only be
+        identical if their shapes are. The 'inode' tier adds each file's inode_key(), so two directories only share
+        it if every file in one is a hard link to the file in the same place in the other. The 'sample256' and
+        'sha256' tiers use each file's digest from that tier, which must already be computed. A subtree with any missing file digest has no digest, and matches nothing.
+        Directory names themselves are left out, so a renamed copy still matches its original.
+        """
+        if tier in self.digests:
+            return self.digests[tier]
+        for node in reversed(self.subtree()):
+            if tier in node.digests:
+                continue
+            entries = []
+            for f in node.files:
+                if tier == 'shape':
+                    entries.append(('f', f.node_name, f.size))
+                elif tier == 'inode':
+                    entries.append(('f', f.node_name, f.size, f.inode_key()))
+                else:
+                    entries.append(('f', f.node_name, f.size, getattr(f, tier)))
+            for subdir in node.subdirs:
+                entries.append(('d', subdir.node_name, subdir.digests[tier]))
+            if None in [entry[-1] for entry in entries]:
+                node.digests[tier] = None
+            else:
+                node.digests[tier] = hash_entries(sorted(entries))
+        return self.digests[tier]
+
+    def find(self, path):
+        """Return the already-walked DirNode for path, somewhere beneath this one, or None if we don't hold it."""
+        relative = os.path.relpath(os.path.abspath(path), os.path.abspath(self.full_path))
+        if relative == os.curdir:
+            return self
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            return None
+        node = self
+        for part in relative.split(os.sep):
+            node = next((sub for sub in node.subdirs if sub.node_name == part), None)
+            if node is None:
+                return None
+        return node
 
     def __iter__(self):
-        return self
-
-    def __next__(self):
-        self.count += 1
-        if self.idx < len(self.parent.files):
-            # Go through parent's files
-            self.idx += 1
-            return self.parent.files[self.idx - 1]
-        elif self.idx < len(self.parent.files) + len(self.parent.subdirs):
-            # For each subdir, pass the buck to a whole new iterator and act as a proxy.
-            if self.it is None:
-                self.it = iter(self.parent.subdirs[self.idx - len(self.parent.files)])
-            try:
-                return next(self.it)
-            except StopIteration:
-                self.idx += 1
-                self.it = None
-                return next(self)
-        else:
-            # If we're out of files and subdirs, just let our caller know
-            raise StopIteration
+        """Yield every file beneath this node, each directory's own files before its subdirectories', without recursing."""
+        for node in self.subtree():
+            yield from node.files
 
-    def __len__(self):
-        return self.count
+    def __reversed__(self):
+        """Yield every file beneath this node in exactly the opposite order to iterating over it."""
+        for node in reversed(self.subtree()):
+            yield from reversed(node.files)
+
+    def __str__(self):
+        return "{0} ({2} in {1} files)".format(self.full_path, self.total_files, size_str(self.total_bytes))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+""" RemovalQueue collects duplicate files and directories, then removes them, or writes a script to, in one batch. """
+
+import contextlib
+import os
+import shlex
+import stat
+import time
+
+import matcher
+import nodes
+
+
+class RemovalQueue():
+    """An ordered, set-backed queue of FileNodes and DirNodes to remove.
+
+    A queued DirNode stands for the files beneath it that were actually compared, never for whatever else may
+    have appeared there since. Nothing is removed if it, or every original it matched, changed on disk after it
+    was compared. Directories are only ever removed once they are empty, and never the protected roots, such as
+    the --from paths themselves.
+    """
+
+    def __init__(self, protected=None):
+        """protected is a list of directories that must survive, even if emptied."""
+        self.nodes = []
+        self.paths = set()
+        self.originals = {}
+        self.protected = protected if protected is not None else []
+        self.removed = []
+        self.removed_dirs = []
+        self.errors = []
+        # Running totals of what was removed, kept when the queue is cleared
+        self.num_removed = 0
+        self.bytes_removed = 0
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __contains__(self, node):
+        return node.full_path in self.paths
+
+    def add(self, node, originals=None):
+        """Queue a node once, however many originals it matched, returning True if it was new to the queue."""
+        if node.full_path in self.paths:
+            return False
+        self.paths.add(node.full_path)
+        self.nodes.append(node)
+        if originals:
+            self.originals[node.full_path] = originals
+        return True
+
+    def clear(self):
+        """Forget everything queued, and what removing it did, keeping only the running totals of what was removed."""
+        self.nodes = []
+        self.paths = set()
+        self.originals = {}
+        self.removed = []
+        self.removed_dirs = []
+        self.errors = []
+
+    def files(self, queued=None):
+        """Return every file to remove, expanding each queued directory into the files verified beneath it."""
+        files = []
+        for node in (self.nodes if queued is None else queued):
+            if isinstance(node, nodes.DirNode):
+                files.extend(node)
+            else:
+                files.append(node)
+        return files
+
+    def unchanged(self, node):
+        """Return True if node, and at least one of the originals it matched, are still as they were compared."""
+        if True in [f.changed() for f in self.files([node, ])]:
+            return False
+        originals = self.originals.get(node.full_path)
+        if originals is None:
+            return True
+        return False in [True in [f.changed() for f in self.files([original, ])] for original in originals]
+
+    def prunable(self, removed_files, queued=None):
+        """Return the directories that removing these files, and queued nodes, may leave empty, deepest first.
+
+        The immediate parent of any removed file qualifies, as does any directory within a protected root that
+        a queued directory, of those removed, or a pruned subdirectory lived in.
+        """
+        dirs = set([os.path.dirname(f.full_path) for f in removed_files])
+        for node in (self.nodes if queued is None else queued):
+            if isinstance(node, nodes.DirNode):
+                dirs.update([sub.full_path for sub in node.subtree()])
+        candidates = set()
+        for d in dirs:
+            while d not in candidates and d not in self.protected:
+                candidates.add(d)
+                parent = os.path.dirname(d)
+                if parent == d or not [root for root in self.protected if matcher.path_within(parent, root)]:
+                    break
+                d = parent
+        return sorted(candidates, key=lambda d: (-len(matcher.path_parts(d)), d))
+
+    def remove(self, queued=None):
+        """Unlink the queued files, or just those of queued nodes, a directory at a time, then prune the directories
+        left empty, bottom-up, once."""
+        files = []
+        removing = []
+        for node in (self.nodes if queued is None else queued):
+            if self.unchanged(node):
+                files.extend(self.files([node, ]))
+                removing.append(node)
+            else:
+                self.errors.append((node.full_path, "changed since it was compared, so it was left alone"))
+        by_dir = {}
+        for f in files:
+            by_dir.setdefault(os.path.dirname(f.full_path), []).append(f)
+        for dir_path, dir_files in by_dir.items():
+            self.unlink_all(dir_path, dir_files)
+        # Only directories that were actually removed, not those declined or changed, have subdirectories to prune.
+        for dir_path in self.prunable(self.removed, removing):
+            if dir_path in self.protected:
+                continue
+            # rmdir refuses to remove a directory that isn't empty, so there's no need to list it first.
+            with contextlib.suppress(OSError):
+                os.rmdir(dir_path)
+                self.removed_dirs.append(dir_path)
+        return len(self.removed)
+
+    def unlink_all(self, dir_path, dir_files):
+        """Unlink files sharing one directory, relative to an open handle on it where the platform allows."""
+        dir_fd = None
+        if os.unlink in os.supports_dir_fd:
+            with contextlib.suppress(OSError):
+                dir_fd = os.open(dir_path, os.O_RDONLY)
+        try:
+            for f in dir_files:
+                try:
+                    if dir_fd is not None:
+                        os.unlink(f.node_name, dir_fd=dir_fd)
+                    else:
+                        os.unlink(f.full_path)
+                    self.removed.append(f)
+                    self.num_removed += 1
+                    self.bytes_removed += f.size
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    self.errors.append((f.full_path, e))
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+
+    def write_script(self, script_path, append=False):
+        """Write a shell script that would remove everything queued, instead of removing anything now.
+
+        With append, everything queued is added to the end of a script already written, so it can grow a batch at a time.
+        """
+        files = self.files()
+        with open(script_path, 'a' if append else 'w') as script:
+            if append:
+                script.write("\n")
+            else:
+                script.write("#!/bin/sh\n")
+                script.write("# Written by dupemgr on {0}\n".format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())))
+            script.write("# Removes {0} duplicate files, then any directories that leaves empty.\n\n".format(len(files)))
+            for f in files:
+                script.write("rm -f -- {0}\n".format(shlex.quote(f.full_path)))
+            script.write("\n")
+            for dir_path in self.prunable(files):
+                if dir_path not in self.protected:
+                    script.write("rmdir -- {0} 2>/dev/null\n".format(shlex.quote(dir_path)))
+        os.chmod(script_path, os.stat(script_path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        return len(files)
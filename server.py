@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+""" IndexServer keeps an index of a tree of originals resident, and answers lookups against it over a Unix socket. """
+
+import json
+import os
+import socket
+import socketserver
+import threading
+
+import grouping
+import hashpool
+import nodes
+import snapshot
+
+
+class IndexServer():
+    """A size and hash index of one tree of originals, kept in memory and refreshed in the background.
+
+    Clients send one JSON request per line and get one JSON reply per line, over as many requests as they like:
+
+        {"op": "lookup", "paths": ["/incoming/a.jpg", ...]}
+            -> {"results": [{"path": "/incoming/a.jpg", "matches": ["/archive/2019/a.jpg"], "error": null}, ...]}
+        {"op": "status"}   -> {"root": ..., "files": ..., "bytes": ..., "builds": ..., "unreadable": ...}
+        {"op": "refresh"}  -> the same status, once the tree has been walked again
+
+    A refresh only lists directories whose mtimes changed, and only the size buckets those directories held or
+    now hold are rebuilt. Hashes survive a refresh for every file whose size, mtime and inode are unchanged, so
+    only new or changed files are ever read again. Lookups hash through the pool, with up to jobs workers per
+    device, outside the lock, so clients never wait on each other's reads; they only share the lock with the index
+    to sort those digests into its hash buckets, which fill in lazily.
+    """
+
+    def __init__(self, root_path, socket_path, excluder=None, walkers=1, jobs=1, refresh=300, prime=None, report=None,
+                 snapshot=None):
+        """Prepare to serve root_path on socket_path, rewalking every refresh seconds (never, if refresh is 0).
+
+        prime(files), if given, fills in cached hashes on the first walk; report(s) is told what the server does.
+        snapshot, if given, lists the first walk's unchanged directories; later walks always list from one.
+        """
+        self.root_path = os.path.abspath(root_path)
+        self.socket_path = os.path.abspath(os.path.expanduser(socket_path))
+        self.excluder = excluder
+        self.walkers = walkers
+        self.pool = hashpool.HashPool(jobs=jobs)
+        self.refresh = refresh
+        self.prime = prime
+        self.report = report
+        self.snapshot = snapshot
+        self.root = None
+        self.index = None
+        self.num_builds = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.server = None
+
+    def say(self, s):
+        if self.report is not None:
+            self.report(s)
+
+    def build(self):
+        """Walk the originals and swap in a fresh index, carrying over every hash that is still valid."""
+        if self.snapshot is None:
+            self.snapshot = snapshot.Snapshot()
+        self.snapshot.restart()
+        root = nodes.DirNode(self.root_path, workers=self.walkers, excluder=self.excluder, snapshot=self.snapshot)
+        self.snapshot.prune([self.root_path, ])
+        old = {}
+        if self.root is not None:
+            with self.lock:
+                old = dict([(f.full_path, f) for f in self.root])
+        elif self.prime is not None:
+            self.prime(root)
+        for f in root:
+            was = old.get(f.full_path)
+            if was is not None and (was.size, was.modified, was.inode) == (f.size, f.modified, f.inode):
+                f.sample256 = was.sample256
+                f.sha256 = was.sha256
+        index = grouping.SizeIndex(root.files_by_size, pool=self.pool)
+        with self.lock:
+            if self.index is not None:
+                index.adopt(self.index, self.snapshot.touched_sizes)
+            before = (self.root.total_files, self.root.total_bytes) if self.root is not None else None
+            self.root = root
+            self.index = index
+            self.num_builds += 1
+        if before != (root.total_files, root.total_bytes):
+            self.say("indexed {0}".format(root))
+
+    def status(self):
+        with self.lock:
+            return {
+                'root': self.root_path,
+                'files': self.root.total_files,
+                'bytes': self.root.total_bytes,
+                'builds': self.num_builds,
+                'unreadable': len(self.pool.errors),
+            }
+
+    def lookup(self, paths):
+        """Return a result for each path: the indexed files holding the same content, or why it couldn't be checked."""
+        results = []
+        found = []
+        for path in paths:
+            result = {'path': path, 'matches': [], 'error': None}
+            try:
+                found.append((result, nodes.FileNode(os.path.abspath(path))))
+            except OSError as e:
+                result['error'] = str(e)
+            results.append(result)
+        with self.lock:
+            index = self.index
+        # A refresh may swap in a new index meanwhile; this lookup finishes against the one it started with.
+        index.prepare([the_file for result, the_file in found])
+        with self.lock:
+            for result, the_file in found:
+                result['matches'] = [f.full_path for f in index.matches(the_file) if f.full_path != the_file.full_path]
+                if the_file.hash_error is not None:
+                    result['error'] = str(the_file.hash_error)
+        return results
+
+    def handle(self, request):
+        """Answer one decoded request, or say what was wrong with it."""
+        if not isinstance(request, dict):
+            return {'error': "A request must be a JSON object, not {0}".format(type(request).__name__)}
+        op = request.get('op', 'lookup')
+        if op == 'lookup':
+            paths = request.get('paths')
+            if not isinstance(paths, list) or False in [isinstance(path, str) for path in paths]:
+                return {'error': "A lookup needs \"paths\", a list of path strings"}
+            return {'results': self.lookup(paths)}
+        elif op == 'status':
+            return self.status()
+        elif op == 'refresh':
+            self.build()
+            return self.status()
+        return {'error': "I cannot \"{0}\"".format(op)}
+
+    def refresher(self):
+        """Rewalk the originals every refresh seconds until the server stops."""
+        while not self.stopped.wait(self.refresh):
+            try:
+                self.build()
+            except OSError as e:
+                self.say("could not refresh {0}: {1}".format(self.root_path, e))
+
+    def serve_forever(self):
+        """Index the originals, then answer requests until interrupted, removing the socket on the way out."""
+        self.build()
+        if os.path.exists(self.socket_path):
+            # Only clear the way if nothing is listening there any more.
+            try:
+                query(self.socket_path, {'op': 'status'})
+            except OSError:
+                os.unlink(self.socket_path)
+            else:
+                raise OSError("Another dupemgr is already serving {0}".format(self.socket_path))
+        if not os.path.isdir(os.path.dirname(self.socket_path)):
+            os.makedirs(os.path.dirname(self.socket_path))
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, IndexRequestHandler)
+        self.server.daemon_threads = True
+        self.server.index_server = self
+        if self.refresh:
+            threading.Thread(target=self.refresher, daemon=True).start()
+        self.say("serving {0} on {1}".format(self.root_path, self.socket_path))
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stopped.set()
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+
+class IndexRequestHandler(socketserver.StreamRequestHandler):
+    """Read JSON requests a line at a time, writing a JSON reply line for each."""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                reply = self.server.index_server.handle(json.loads(line.decode('utf-8')))
+            except ValueError as e:
+                reply = {'error': "I did not understand that request: {0}".format(e)}
+            self.wfile.write((json.dumps(reply) + "\n").encode('utf-8'))
+            self.wfile.flush()
+
+
+def query(socket_path, request):
+    """Send one request to a running IndexServer and return its decoded reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(os.path.abspath(os.path.expanduser(socket_path)))
+        with sock.makefile('rwb') as stream:
+            stream.write((json.dumps(request) + "\n").encode('utf-8'))
+            stream.flush()
+            return json.loads(stream.readline().decode('utf-8'))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+""" Index shards record one host's files by size and hash, so hosts can be compared without moving any file data. """
+
+import gzip
+import heapq
+import json
+import os
+import time
+
+import nodes
+import snapshot
+
+# Support functions for this package are defined in localutils.py
+from localutils import *
+
+
+class Shard():
+    """A gzipped JSON-lines file of [size, digest, path, mtime, device, inode] records, one per file, sorted by size and digest.
+
+    The first line is a header naming the host, the root that was indexed, and the hash algorithm used. Sorting
+    lets any number of shards be merged a record at a time, so merging never holds more than one size and digest
+    group in memory, however many files the hosts hold between them.
+    """
+
+    version = 1
+
+    def __init__(self, shard_path):
+        self.shard_path = os.path.expanduser(shard_path)
+        self.header = None
+
+    def __str__(self):
+        if self.header is None:
+            return self.shard_path
+        return "{0} ({1}:{2})".format(self.shard_path, self.header['host'], self.header['root'])
+
+    def write(self, files, host, root):
+        """Write a record for every file in files with a full hash, returning how many were written."""
+        records = []
+        for f in files:
+            if f.sha256 is None:
+                continue
+            record = f.as_dict(host)
+            records.append([record['size'], record['sha256'], os.path.join(record['path'], record['name']),
+                            record['modified'], f.device, record['inode']])
+        records.sort()
+        self.header = {'version': self.version, 'host': host, 'root': root, 'algorithm': HASHING['algorithm'],
+                       'created': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()), 'files': len(records)}
+        with gzip.open(self.shard_path + ".tmp", 'wt') as shard_file:
+            shard_file.write(json.dumps(self.header) + "\n")
+            for record in records:
+                shard_file.write(json.dumps(record) + "\n")
+        os.replace(self.shard_path + ".tmp", self.shard_path)
+        return len(records)
+
+    def read_header(self):
+        """Read and check the header, raising ValueError if this isn't a shard we can read."""
+        with gzip.open(self.shard_path, 'rt') as shard_file:
+            self.header = json.loads(shard_file.readline())
+        if self.header.get('version') != self.version:
+            raise ValueError("{0} is not a version {1} index shard".format(self.shard_path, self.version))
+        return self.header
+
+    def records(self):
+        """Yield (size, digest, host, path, mtime, device, inode) for every file recorded, in order of size and digest."""
+        host = self.read_header()['host']
+        with gzip.open(self.shard_path, 'rt') as shard_file:
+            shard_file.readline()
+            for line in shard_file:
+                size, digest, path, modified, device, inode = json.loads(line)
+                yield size, digest, host, path, modified, device, inode
+
+
+def record_node(record):
+    """Return a FileNode standing in for a shard record, named host:path, with its digest already filled in.
+
+    Its device is qualified by host too, so only hard links on the same host share an inode_key().
+    """
+    size, digest, host, path, modified, device, inode = record
+    f = nodes.FileNode(snapshot.Entry("{0}:{1}".format(host, os.path.dirname(path)), os.path.basename(path),
+                                      size, modified, modified, "{0}:{1}".format(host, device), inode, 1))
+    f.sha256 = digest
+    return f
+
+
+def cross_host_groups(shards):
+    """Yield [FileNode, ...] for every size and digest held by files on more than one host, merging shards in order."""
+    group = []
+    for record in heapq.merge(*[shard.records() for shard in shards]):
+        if group and record[:2] != group[0][:2]:
+            if len(set([r[2] for r in group])) > 1:
+                yield [record_node(r) for r in group]
+            group = []
+        group.append(record)
+    if len(set([r[2] for r in group])) > 1:
+        yield [record_node(r) for r in group]
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+""" Snapshot remembers each directory's mtime and listing, so a later walk can skip directories that haven't changed. """
+
+import gzip
+import json
+import os
+import threading
+import time
+
+import matcher
+import nodes
+
+# A directory modified this close to when it was listed may have changed again within the same mtime tick.
+RACY_SECONDS = 2.0
+
+
+class Entry():
+    """A file recorded in a snapshot, standing in for the os.DirEntry a FileNode is usually built from."""
+
+    __slots__ = ('name', 'path', 'st_size', 'st_ctime', 'st_mtime', 'st_dev', 'st_ino', 'st_nlink', )
+
+    def __init__(self, dir_path, name, size, created, modified, device, inode, links):
+        self.name = name
+        self.path = os.path.join(dir_path, name)
+        self.st_size = size
+        self.st_ctime = created
+        self.st_mtime = modified
+        self.st_dev = device
+        self.st_ino = inode
+        self.st_nlink = links
+
+    def stat(self):
+        return self
+
+
+class Snapshot():
+    """Listings of directories, keyed by path, each with the mtime the directory had when it was listed.
+
+    Adding, removing or renaming anything in a directory changes its mtime, so a directory whose mtime still
+    matches is listed from here, without a scandir or a stat of each file in it. Rewriting a file in place does
+    not change its directory's mtime, though, so reused file records can be stale; RemovalQueue checks every file
+    against the disk again before removing anything. A snapshot is only used by runs with the same exclusions.
+    """
+
+    version = 1
+
+    def __init__(self, excluding=None):
+        """Start an empty snapshot for walks that exclude the paths and names in excluding."""
+        self.excluding = sorted(excluding) if excluding else []
+        self.dirs = {}
+        self.visited = set()
+        self.touched_sizes = set()
+        self.lock = threading.Lock()
+        self.num_reused_dirs = 0
+        self.num_rescanned_dirs = 0
+        self.num_reused_files = 0
+        self.num_rescanned_files = 0
+
+    def __len__(self):
+        return len(self.dirs)
+
+    def __str__(self):
+        return "reused {0} of {1} directories and {2} of {3} files".format(
+            self.num_reused_dirs, self.num_reused_dirs + self.num_rescanned_dirs,
+            self.num_reused_files, self.num_reused_files + self.num_rescanned_files)
+
+    def load(self, snapshot_path):
+        """Read the directory records from snapshot_path, unless it is missing or was made with other exclusions."""
+        snapshot_path = os.path.expanduser(snapshot_path)
+        if not os.path.isfile(snapshot_path):
+            return 0
+        with gzip.open(snapshot_path, 'rt') as snapshot_file:
+            header = json.loads(snapshot_file.readline())
+            if header.get('version') != self.version or header.get('excluding') != self.excluding:
+                return 0
+            for line in snapshot_file:
+                record = json.loads(line)
+                self.dirs[record[0]] = tuple(record[1:])
+        return len(self.dirs)
+
+    def save(self, snapshot_path):
+        """Write every directory record to snapshot_path, replacing it all at once."""
+        snapshot_path = os.path.expanduser(snapshot_path)
+        if not os.path.isdir(os.path.dirname(os.path.abspath(snapshot_path))):
+            os.makedirs(os.path.dirname(os.path.abspath(snapshot_path)))
+        with gzip.open(snapshot_path + ".tmp", 'wt') as snapshot_file:
+            snapshot_file.write(json.dumps({'version': self.version, 'excluding': self.excluding}) + "\n")
+            for path, record in self.dirs.items():
+                snapshot_file.write(json.dumps([path, ] + list(record)) + "\n")
+        os.replace(snapshot_path + ".tmp", snapshot_path)
+        return len(self.dirs)
+
+    def scan(self, path, keep=None):
+        """List one directory like nodes.scan_dir, from its record if its mtime is unchanged, recording it if not."""
+        modified = os.stat(path).st_mtime
+        record = self.dirs.get(path)
+        if record is not None and record[0] == modified and modified < record[1] - RACY_SECONDS:
+            dirs = [os.path.join(path, name) for name in record[2] if keep is None or keep(name)]
+            files = [Entry(path, *f) for f in record[3] if keep is None or keep(f[0])]
+            with self.lock:
+                self.visited.add(path)
+                self.num_reused_dirs += 1
+                self.num_reused_files += len(files)
+            return dirs, files
+        scanned = time.time()
+        dirs, files = nodes.scan_dir(path, keep)
+        listed = []
+        for entry in files:
+            fstat = entry.stat()
+            listed.append([entry.name, fstat.st_size, fstat.st_ctime, fstat.st_mtime, fstat.st_dev, fstat.st_ino,
+                           fstat.st_nlink])
+        with self.lock:
+            if record is not None:
+                self.touched_sizes.update([f[1] for f in record[3]])
+            self.touched_sizes.update([f[1] for f in listed])
+            self.dirs[path] = (modified, scanned, [os.path.basename(d) for d in dirs], listed)
+            self.visited.add(path)
+            self.num_rescanned_dirs += 1
+            self.num_rescanned_files += len(listed)
+        return dirs, files
+
+    def prune(self, roots):
+        """Forget directories within any of roots that the walks of roots no longer reached, as they're gone."""
+        for path in [path for path in self.dirs if path not in self.visited]:
+            if True in [matcher.path_within(path, root) for root in roots]:
+                self.touched_sizes.update([f[1] for f in self.dirs[path][3]])
+                del self.dirs[path]
+
+    def restart(self):
+        """Clear what the last walks visited and touched, before walking again."""
+        with self.lock:
+            self.visited = set()
+            self.touched_sizes = set()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+""" RunStats collects wall time per phase, and counters of the work done, over one dupemgr run. """
+
+import contextlib
+import json
+import time
+
+
+class RunStats():
+    """Wall time spent walking, grouping, hashing, reporting and removing, and how much work each phase did.
+
+    Phases are timed as they happen, except hashing, which HashPool times itself, and grouping, which is whatever
+    searching took beyond the other phases. Counters start at zero and are only ever added to.
+    """
+
+    phases = ('walk', 'group', 'hash', 'report', 'remove', )
+    counters = ('dirs_scanned', 'stat_calls', 'files_hashed', 'bytes_hashed', 'cache_hits', 'comparisons',
+                'files_unlinked', 'bytes_unlinked', )
+
+    def __init__(self):
+        self.seconds = dict([(phase, 0.0) for phase in self.phases])
+        self.counts = dict([(counter, 0) for counter in self.counters])
+        self.timers = {}
+        # Hashing throughput of each device read, from HashPool.device_report()
+        self.devices = {}
+
+    def __str__(self):
+        return ", ".join(["{0} {1:0.2f}s".format(phase, self.seconds[phase]) for phase in self.phases])
+
+    @contextlib.contextmanager
+    def timing(self, phase):
+        """Add the wall time spent within this context to phase."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.seconds[phase] += time.time() - start
+
+    def count(self, counter, n=1):
+        self.counts[counter] += n
+
+    def as_dict(self):
+        return {
+            'seconds': dict(self.seconds, **self.timers),
+            'counts': dict(self.counts),
+            'devices': dict(self.devices),
+        }
+
+    def write(self, stats_path):
+        """Write the stats as one JSON block to stats_path, or print it if stats_path is '-'."""
+        block = json.dumps(self.as_dict(), indent=2)
+        if stats_path == '-':
+            print(block)
+        else:
+            with open(stats_path, 'w') as stats_file:
+                stats_file.write(block + "\n")
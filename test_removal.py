@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+""" Tests for RemovalQueue, run with python -m pytest, or python -m unittest, from this directory. """
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import nodes
+import removal
+
+
+class RemovalQueueTest(unittest.TestCase):
+    """Remove, or script the removal of, duplicates within a protected target tree, checked against originals."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='dupemgr-test-')
+        self.orig = os.path.join(self.root, 'orig')
+        self.target = os.path.join(self.root, 'target')
+        os.makedirs(self.orig)
+        os.makedirs(os.path.join(self.target, 'a', 'b'))
+        os.makedirs(os.path.join(self.target, 'c'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write(self, *parts, data=b'same'):
+        path = os.path.join(*parts)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return nodes.FileNode(path)
+
+    def queue(self):
+        return removal.RemovalQueue(protected=[self.target, ])
+
+    def test_protected_root_survives(self):
+        original = self.write(self.orig, 'x')
+        rmqueue = self.queue()
+        rmqueue.add(self.write(self.target, 'x'), [original, ])
+        self.assertEqual(rmqueue.remove(), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.target, 'x')))
+        self.assertTrue(os.path.isdir(self.target))
+        self.assertNotIn(self.target, rmqueue.removed_dirs)
+        self.assertTrue(os.path.isfile(original.full_path))
+
+    def test_changed_file_is_skipped(self):
+        original = self.write(self.orig, 'x')
+        extra = self.write(self.target, 'a', 'x')
+        # Same size, so only the mtime and content give the change away, however coarse the filesystem's clock.
+        self.write(self.target, 'a', 'x', data=b'diff')
+        os.utime(extra.full_path, (extra.modified + 10, extra.modified + 10))
+        rmqueue = self.queue()
+        rmqueue.add(extra, [original, ])
+        self.assertEqual(rmqueue.remove(), 0)
+        self.assertTrue(os.path.isfile(extra.full_path))
+        self.assertEqual([path for path, e in rmqueue.errors], [extra.full_path, ])
+
+    def test_changed_originals_are_skipped(self):
+        original = self.write(self.orig, 'x')
+        extra = self.write(self.target, 'x')
+        os.remove(original.full_path)
+        rmqueue = self.queue()
+        rmqueue.add(extra, [original, ])
+        self.assertEqual(rmqueue.remove(), 0)
+        self.assertTrue(os.path.isfile(extra.full_path))
+
+    def test_only_emptied_dirs_are_removed(self):
+        original = self.write(self.orig, 'x')
+        rmqueue = self.queue()
+        rmqueue.add(self.write(self.target, 'a', 'b', 'x'), [original, ])
+        rmqueue.add(self.write(self.target, 'c', 'x'), [original, ])
+        kept = self.write(self.target, 'c', 'kept', data=b'unique')
+        self.assertEqual(rmqueue.remove(), 2)
+        self.assertEqual(rmqueue.removed_dirs, [os.path.join(self.target, 'a', 'b'), os.path.join(self.target, 'a'), ])
+        self.assertTrue(os.path.isfile(kept.full_path))
+        self.assertTrue(os.path.isdir(self.target))
+
+    def test_declined_dir_keeps_its_subdirs(self):
+        original = self.write(self.orig, 'x')
+        os.makedirs(os.path.join(self.target, 'q', 'empty'))
+        self.write(self.target, 'q', 'x')
+        rmqueue = self.queue()
+        extra = self.write(self.target, 'x')
+        rmqueue.add(extra, [original, ])
+        rmqueue.add(nodes.DirNode(os.path.join(self.target, 'q')), [nodes.DirNode(self.orig), ])
+        self.assertEqual(rmqueue.remove([extra, ]), 1)
+        self.assertTrue(os.path.isdir(os.path.join(self.target, 'q', 'empty')))
+        self.assertEqual(rmqueue.removed_dirs, [])
+
+    def test_prunable_is_deepest_first_within_protected_roots(self):
+        rmqueue = self.queue()
+        extra = self.write(self.target, 'a', 'b', 'x')
+        self.assertEqual(rmqueue.prunable([extra, ]), [os.path.join(self.target, 'a', 'b'), os.path.join(self.target, 'a'), ])
+        # Outside any protected root, only a removed file's own directory may go.
+        self.assertEqual(rmqueue.prunable([self.write(self.orig, 'x'), ]), [self.orig, ])
+
+    def test_write_script_removes_nothing(self):
+        original = self.write(self.orig, 'x')
+        extra = self.write(self.target, 'a', 'b', "it's")
+        rmqueue = self.queue()
+        rmqueue.add(extra, [original, ])
+        script_path = os.path.join(self.root, 'rm.sh')
+        self.assertEqual(rmqueue.write_script(script_path), 1)
+        self.assertTrue(os.path.isfile(extra.full_path))
+        self.assertTrue(os.stat(script_path).st_mode & stat.S_IXUSR)
+        with open(script_path) as script:
+            lines = [line.rstrip("\n") for line in script if line.strip() and not line.startswith('#')]
+        self.assertEqual(lines, [
+            "rm -f -- '{0}'\"'\"'s'".format(os.path.join(self.target, 'a', 'b', 'it')),
+            "rmdir -- {0} 2>/dev/null".format(os.path.join(self.target, 'a', 'b')),
+            "rmdir -- {0} 2>/dev/null".format(os.path.join(self.target, 'a')),
+        ])
+
+    def test_write_script_appends(self):
+        original = self.write(self.orig, 'x')
+        rmqueue = self.queue()
+        rmqueue.add(self.write(self.target, 'x'), [original, ])
+        script_path = os.path.join(self.root, 'rm.sh')
+        rmqueue.write_script(script_path)
+        rmqueue.clear()
+        rmqueue.add(self.write(self.target, 'c', 'x'), [original, ])
+        rmqueue.write_script(script_path, append=True)
+        with open(script_path) as script:
+            text = script.read()
+        self.assertEqual(text.count("#!/bin/sh"), 1)
+        self.assertEqual(text.count("rm -f -- "), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()